@@ -0,0 +1,100 @@
+"""
+Measure bulk job memory as the CSV grows.
+
+Usage: python benchmarks/bench_bulk.py [--dynamic] [--distinct=N] [rows ...]
+       (default 1000 10000)
+
+Runs process_bulk_qr_code on generated CSVs of each size (try 100000) in
+a forked child, with Celery in eager mode, against the configured
+database with a throwaway MEDIA_ROOT. Everything the job writes to the
+database is rolled back. Reports how far the job raised the child's peak
+RSS. Only the ZIP directory entries (a few hundred bytes per code) should
+grow with the row count: each chunk's archive is spooled to disk, and so
+is the merge.
+
+With --dynamic the CSV has destination_url instead of data, so every row
+becomes a dynamic code with an allocated short URL. With --distinct=N
+static rows cycle through N payloads, so the job renders N images (one
+per payload and size) and aliases the rest.
+"""
+import os
+import resource
+import sys
+import tempfile
+import time
+import zipfile
+from multiprocessing import get_context
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'quantumqr.settings')
+# Run the job's chunk and merge tasks inline
+os.environ['CELERY_TASK_ALWAYS_EAGER'] = 'True'
+os.environ.setdefault('QR_PUBLIC_BASE_URL', 'https://qr.example.com')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.files.base import ContentFile  # noqa: E402
+from django.db import connections, transaction  # noqa: E402
+from django.test import override_settings  # noqa: E402
+
+from qrgen.models import BulkQRJob, User  # noqa: E402
+from qrgen.tasks import process_bulk_qr_code  # noqa: E402
+
+
+def make_csv(rows, dynamic, distinct):
+    column = 'destination_url' if dynamic else 'data'
+    lines = [f'name,{column},fill_color,back_color,error_correction,size']
+    lines += [f'code {i},https://example.com/item/{i % distinct:08d},'
+              f'#000000,#FFFFFF,M,{(300, 500)[i % 2]}' for i in range(rows)]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def run(rows, dynamic, distinct, results):
+    with tempfile.TemporaryDirectory() as media, \
+            override_settings(MEDIA_ROOT=media, DEBUG=False), \
+            transaction.atomic():
+        user = User.objects.create(username='bench-bulk')
+        csv_file = ContentFile(make_csv(rows, dynamic, distinct or rows),
+                               name='bench.csv')
+        job = BulkQRJob.objects.create(user=user, file=csv_file)
+        baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        process_bulk_qr_code(job.id)
+        elapsed = time.perf_counter() - start
+        peak_kb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                   - baseline_kb)
+        job.refresh_from_db()
+        with job.result.open('rb') as f:
+            entries = len(zipfile.ZipFile(f).namelist())
+        archive_mb = job.result.size / 1e6
+        transaction.set_rollback(True)
+    results.put((job.status, entries, archive_mb, elapsed, peak_kb))
+
+
+def main():
+    dynamic = '--dynamic' in sys.argv
+    distinct = next((int(arg.split('=', 1)[1]) for arg in sys.argv[1:]
+                     if arg.startswith('--distinct=')), None)
+    counts = [int(arg) for arg in sys.argv[1:]
+              if not arg.startswith('--')] or [1000, 10000]
+    print(f'{"rows":>8} {"status":>10} {"entries":>8} {"ZIP MB":>7} '
+          f'{"seconds":>8} {"+peak RSS MB":>12}')
+    ctx = get_context('fork')
+    for rows in counts:
+        # The child must open its own database connection
+        connections.close_all()
+        results = ctx.Queue()
+        process = ctx.Process(target=run,
+                              args=(rows, dynamic, distinct, results))
+        process.start()
+        status, entries, archive_mb, elapsed, peak_kb = results.get()
+        process.join()
+        print(f'{rows:>8} {status:>10} {entries:>8} {archive_mb:>7.1f} '
+              f'{elapsed:>8.1f} {peak_kb / 1024:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Check and benchmark the NumPy QR encoder against the qrcode package.
+
+Usage: python benchmarks/bench_encoder.py [codes]
+
+Encodes a corpus covering numeric, alphanumeric, byte and multi-byte UTF-8
+payloads at every error correction level, from version 1 up to 40. The
+corpus also includes a stream of short-URL payloads like the ones dynamic
+codes carry. Every result must match the reference module for module, with
+the same version and mask. Exits non-zero on any difference.
+"""
+import os
+import random
+import string
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'quantumqr.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+import numpy as np  # noqa: E402
+import qrcode  # noqa: E402
+
+from qrgen import encoder  # noqa: E402
+
+LEVELS = {
+    'L': qrcode.constants.ERROR_CORRECT_L,
+    'M': qrcode.constants.ERROR_CORRECT_M,
+    'Q': qrcode.constants.ERROR_CORRECT_Q,
+    'H': qrcode.constants.ERROR_CORRECT_H,
+}
+LENGTHS = [1, 2, 5, 10, 17, 30, 50, 80, 120, 200, 300, 500, 800, 1200,
+           1800, 2300]
+
+
+def reference(data, error_correction):
+    qr = qrcode.QRCode(version=1, error_correction=error_correction,
+                       border=0)
+    qr.add_data(data)
+    qr.make(fit=True)
+    return qr
+
+
+def reference_mask(qr):
+    """make() does not keep the mask it picked; find it (untimed)"""
+    modules = qr.modules
+    mask = qr.best_mask_pattern()
+    qr.makeImpl(False, mask)
+    assert qr.modules == modules
+    return mask
+
+
+def corpus(rng, codes):
+    alnum = string.ascii_uppercase + string.digits + ' $%*+-./:'
+    for length in LENGTHS:
+        yield ''.join(rng.choice(string.printable) for _ in range(length))
+        yield ''.join(rng.choice(string.digits) for _ in range(length * 2))
+        yield ''.join(rng.choice(alnum) for _ in range(length))
+        yield ''.join(chr(rng.randrange(0x400, 0x4ff))
+                      for _ in range(length // 2 + 1))
+        yield 'https://example.com/' + ''.join(
+            rng.choice(string.ascii_letters) for _ in range(length))
+    for _ in range(codes):
+        code = ''.join(rng.choice(string.ascii_letters + string.digits)
+                       for _ in range(7))
+        yield f'https://qr.example.com/redirect/{code}/'
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+    except (qrcode.exceptions.DataOverflowError, ValueError):
+        # The reference reports overflow as ValueError past version 40
+        result = None
+    return result, time.perf_counter() - start
+
+
+def main():
+    codes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rng = random.Random(42)
+    checked = mismatches = 0
+    times = {}
+    for data in corpus(rng, codes):
+        for level, error_correction in LEVELS.items():
+            qr, reference_s = timed(reference, data, error_correction)
+            actual, encoder_s = timed(encoder.encode, data, error_correction)
+            if qr is None and actual is None:
+                continue
+            expected = qr and (np.array(qr.modules, dtype=np.uint8),
+                               qr.version, reference_mask(qr))
+            checked += 1
+            if (expected is None or actual is None
+                    or expected[1:] != actual[1:]
+                    or not np.array_equal(expected[0], actual[0])):
+                mismatches += 1
+                print(f'MISMATCH level {level}, {len(data)} chars: '
+                      f'{data[:40]!r}')
+                continue
+            bucket = times.setdefault(expected[1], [0, 0.0, 0.0])
+            bucket[0] += 1
+            bucket[1] += reference_s
+            bucket[2] += encoder_s
+
+    print(f'{checked} encodings compared, {mismatches} mismatches\n')
+    print(f'{"version":>8} {"codes":>6} {"qrcode ms":>10} {"numpy ms":>10} '
+          f'{"speedup":>8}')
+    for version in sorted(times):
+        count, reference_s, encoder_s = times[version]
+        print(f'{version:>8} {count:>6} {reference_s / count * 1000:>10.2f} '
+              f'{encoder_s / count * 1000:>10.2f} '
+              f'{reference_s / encoder_s:>7.1f}x')
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark logo handling for large uploads.
+
+Usage: python benchmarks/bench_logo.py [iterations]
+
+Compares the previous per-request path (decode the original upload,
+LANCZOS-resize it, convert to RGBA) with the prepared path (normalize once
+on upload, then paste a cached bitmap). The one-off upload cost is shown
+separately and is included in the prepared path's per-render time. Each
+case runs in a forked child and reports how far it raised peak RSS.
+"""
+import io
+import os
+import resource
+import sys
+import time
+from multiprocessing import get_context
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'quantumqr.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+import numpy as np  # noqa: E402
+from django.core.files.base import ContentFile  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from qrgen.logos import logo_bitmap, prepare_logo  # noqa: E402
+
+QR_SIZE = 500
+UPLOADS = [('jpeg', 4000, 3000), ('png', 2400, 2400)]
+
+
+def make_upload(fmt, width, height):
+    rng = np.random.default_rng(42)
+    # Smooth gradient plus noise: compresses like a photo, not like noise
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // width, y * 255 // height,
+                     (x + y) * 255 // (width + height)], axis=-1)
+    noise = rng.integers(0, 32, size=base.shape)
+    pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format=fmt.upper())
+    return buffer.getvalue()
+
+
+def legacy(upload, iterations):
+    """What add_logo_to_qr did on every render"""
+    for _ in range(iterations):
+        logo = Image.open(io.BytesIO(upload))
+        logo_size = int(QR_SIZE * 0.25)
+        resized = logo.resize((logo_size, logo_size),
+                              Image.Resampling.LANCZOS)
+        if resized.mode != 'RGBA':
+            resized = resized.convert('RGBA')
+
+
+def prepared(upload, iterations):
+    """Normalize once, then look up the bitmap for each render"""
+    start = time.perf_counter()
+    prepared_png = prepare_logo(io.BytesIO(upload))
+    prepare_ms = (time.perf_counter() - start) * 1000
+    stored = ContentFile(prepared_png, name='bench/logo.png')
+    for _ in range(iterations):
+        logo_bitmap(stored, QR_SIZE)
+    return prepare_ms, len(prepared_png)
+
+
+def run(func, upload, iterations, results):
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    extra = func(upload, iterations)
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_kb
+    results.put((elapsed / iterations * 1000, peak_kb, extra))
+
+
+def measure(func, upload, iterations):
+    ctx = get_context('fork')
+    results = ctx.Queue()
+    process = ctx.Process(target=run, args=(func, upload, iterations,
+                                            results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print(f'Logo on a {QR_SIZE}px code, {iterations} renders per case\n')
+    print(f'{"upload":>22} {"path":>9} {"ms/render":>10} '
+          f'{"+peak RSS MB":>12} {"stored KB":>10} {"upload ms":>10}')
+    for fmt, width, height in UPLOADS:
+        upload = make_upload(fmt, width, height)
+        label = f'{fmt} {width}x{height} {len(upload) / 1e6:.1f}MB'
+        ms, peak_kb, _ = measure(legacy, upload, iterations)
+        print(f'{label:>22} {"legacy":>9} {ms:>10.2f} '
+              f'{peak_kb / 1024:>12.1f} '
+              f'{len(upload) / 1024:>10.0f}')
+        ms, peak_kb, (prepare_ms, stored) = measure(prepared, upload,
+                                                    iterations)
+        print(f'{"":>22} {"prepared":>9} {ms:>10.2f} '
+              f'{peak_kb / 1024:>12.1f} '
+              f'{stored / 1024:>10.0f} {prepare_ms:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark PNG output size and encode time.
+
+Usage: python benchmarks/bench_png.py [iterations]
+
+Compares the previous output (a 24-bit RGB image saved with default PNG
+settings) with the palette profile qr_to_png now uses for codes without a
+logo (1-bit pixels, QR_PNG_COMPRESS_LEVEL, QR_PNG_ZLIB_STRATEGY). A few
+other zlib level/strategy pairs are listed for tuning. Also reports the
+total for a bulk-style batch of short-URL codes, as zipped by the bulk job.
+"""
+import io
+import os
+import sys
+import time
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'quantumqr.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+
+from qrgen.utils import generate_qr_code, qr_to_png  # noqa: E402
+
+SIZES = [300, 1000]
+PAYLOADS = {
+    'short URL': 'https://qr.example.com/redirect/aB3dE9x/',
+    '300 chars': 'https://example.com/?q=' + 'x7Kp2' * 60,
+}
+# (label, save options) for the 1-bit palette image
+TUNING = [
+    ('level 1', {'compress_level': 1}),
+    ('level 9', {'compress_level': 9}),
+    ('level 9 filtered', {'compress_level': 9, 'compress_type': 1}),
+    ('level 6 RLE', {'compress_level': 6, 'compress_type': 3}),
+]
+BATCH = 500
+
+
+def legacy_png(img):
+    """What qr_to_png did before: RGB pixels, default settings"""
+    buffer = io.BytesIO()
+    img.convert('RGB').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def tuned_png(img, options):
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG', bits=1, **options)
+    return buffer.getvalue()
+
+
+def timed(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        data = func()
+    return len(data), (time.perf_counter() - start) / iterations * 1000
+
+
+def zipped(images, encode):
+    buffer = io.BytesIO()
+    start = time.perf_counter()
+    with zipfile.ZipFile(buffer, 'w') as zip_file:
+        for i, img in enumerate(images):
+            zip_file.writestr(f'code {i}.png', encode(img))
+    return len(buffer.getvalue()), time.perf_counter() - start
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    print(f'zlib level {settings.QR_PNG_COMPRESS_LEVEL}, strategy '
+          f'{settings.QR_PNG_ZLIB_STRATEGY}; {iterations} encodes per row\n')
+    print(f'{"payload":>10} {"size":>5} {"profile":>18} {"bytes":>7} '
+          f'{"ms":>7} {"smaller":>8} {"faster":>7}')
+    for label, data in PAYLOADS.items():
+        for size in SIZES:
+            img = generate_qr_code(data, size=size)
+            rows = [('legacy RGB', lambda: legacy_png(img)),
+                    ('palette', lambda: qr_to_png(img).getvalue())]
+            rows += [(name, lambda options=options: tuned_png(img, options))
+                     for name, options in TUNING]
+            legacy_bytes, legacy_ms = timed(rows[0][1], iterations)
+            for name, func in rows:
+                length, ms = timed(func, iterations)
+                print(f'{label:>10} {size:>5} {name:>18} {length:>7} '
+                      f'{ms:>7.2f} {legacy_bytes / length:>7.1f}x '
+                      f'{legacy_ms / ms:>6.1f}x')
+            print()
+
+    images = [generate_qr_code(f'https://qr.example.com/redirect/{i:07d}/')
+              for i in range(BATCH)]
+    legacy_bytes, legacy_s = zipped(images, legacy_png)
+    palette_bytes, palette_s = zipped(
+        images, lambda img: qr_to_png(img).getvalue())
+    print(f'ZIP of {BATCH} 300px codes: {legacy_bytes / 1024:.0f} KB in '
+          f'{legacy_s * 1000:.0f} ms -> {palette_bytes / 1024:.0f} KB in '
+          f'{palette_s * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
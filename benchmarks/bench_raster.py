@@ -0,0 +1,79 @@
+"""
+Benchmark QR rasterization against the old render-then-resize path.
+
+Usage: python benchmarks/bench_raster.py [iterations]
+
+For each output size, times the previous approach (make_image at
+box_size=10, then a LANCZOS resize) and the NumPy rasterizer, and counts
+the distinct colors in the result: a sharp two-color image has exactly 2.
+Both paths include encoding; "raster ms" is the NumPy rasterizer alone.
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'quantumqr.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+import qrcode  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from qrgen.utils import (encode_qr, error_correction_map,  # noqa: E402
+                         hex_to_rgb, make_matrix, rasterize)
+
+DATA = 'https://example.com/redirect/aB3dE9x/'
+FILL = '#1A2B3C'
+BACK = '#F0F0F0'
+SIZES = [100, 200, 300, 500, 750, 1000]
+
+
+def legacy_render(size):
+    qr = qrcode.QRCode(version=1, error_correction=error_correction_map['M'],
+                       box_size=10, border=4)
+    qr.add_data(DATA)
+    qr.make(fit=True)
+    return qr.make_image(fill_color=hex_to_rgb(FILL),
+                         back_color=hex_to_rgb(BACK)).resize(
+        (size, size), Image.Resampling.LANCZOS)
+
+
+def numpy_render(size):
+    # Bypass the matrix memo so every iteration pays for encoding
+    modules = encode_qr.__wrapped__(DATA, 'M').modules
+    return rasterize(make_matrix(DATA, 'M', modules=modules), size,
+                     hex_to_rgb(FILL), hex_to_rgb(BACK))
+
+
+def raster_only(size, matrix=make_matrix(DATA, 'M')):
+    return rasterize(matrix, size, hex_to_rgb(FILL), hex_to_rgb(BACK))
+
+
+def timed(func, size, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        img = func(size)
+    return (time.perf_counter() - start) / iterations * 1000, img
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    print(f'{"size":>6} {"legacy ms":>10} {"numpy ms":>10} {"raster ms":>10} {"speedup":>8} '
+          f'{"legacy colors":>14} {"numpy colors":>13}')
+    for size in SIZES:
+        legacy_ms, legacy_img = timed(legacy_render, size, iterations)
+        numpy_ms, numpy_img = timed(numpy_render, size, iterations)
+        raster_ms, _ = timed(raster_only, size, iterations)
+        legacy_colors = len(legacy_img.getcolors(size * size))
+        numpy_colors = len(numpy_img.getcolors(size * size))
+        print(f'{size:>6} {legacy_ms:>10.2f} {numpy_ms:>10.2f} {raster_ms:>10.2f} '
+              f'{legacy_ms / numpy_ms:>7.1f}x {legacy_colors:>14} '
+              f'{numpy_colors:>13}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark the scan user agent classifier against the old chained checks.
+
+Usage: python benchmarks/bench_useragent.py [iterations]
+
+Reports accuracy on the labelled corpus in user_agents.csv and throughput
+for a skewed stream where a few agents account for most scans.
+"""
+import csv
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'quantumqr.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from qrgen.useragent import classify  # noqa: E402
+
+
+def legacy_classify(user_agent):
+    """The chained substring checks previously used in qrgen.views"""
+    ua_lower = user_agent.lower()
+    if 'mobile' in ua_lower or 'android' in ua_lower:
+        device = 'Mobile'
+    elif 'tablet' in ua_lower or 'ipad' in ua_lower:
+        device = 'Tablet'
+    else:
+        device = 'Desktop'
+
+    if 'Chrome' in user_agent:
+        browser = 'Chrome'
+    elif 'Firefox' in user_agent:
+        browser = 'Firefox'
+    elif 'Safari' in user_agent:
+        browser = 'Safari'
+    elif 'Edge' in user_agent:
+        browser = 'Edge'
+    else:
+        browser = 'Unknown'
+
+    if 'Windows' in user_agent:
+        os_name = 'Windows'
+    elif 'Mac' in user_agent:
+        os_name = 'macOS'
+    elif 'Linux' in user_agent:
+        os_name = 'Linux'
+    elif 'Android' in user_agent:
+        os_name = 'Android'
+    elif ('iOS' in user_agent or 'iPhone' in user_agent
+          or 'iPad' in user_agent):
+        os_name = 'iOS'
+    else:
+        os_name = 'Unknown'
+    return device, browser, os_name
+
+
+def new_classify(user_agent):
+    result = classify(user_agent)
+    return result.device_type, result.browser, result.os
+
+
+def load_corpus():
+    path = Path(__file__).resolve().parent / 'user_agents.csv'
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def accuracy(corpus, func):
+    correct = {'device_type': 0, 'browser': 0, 'os': 0}
+    for row in corpus:
+        device, browser, os_name = func(row['user_agent'])
+        correct['device_type'] += device == row['device_type']
+        correct['browser'] += browser == row['browser']
+        correct['os'] += os_name == row['os']
+    return {key: value / len(corpus) for key, value in correct.items()}
+
+
+def throughput(stream, func):
+    start = time.perf_counter()
+    for user_agent in stream:
+        func(user_agent)
+    elapsed = time.perf_counter() - start
+    return len(stream) / elapsed
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    corpus = load_corpus()
+    agents = [row['user_agent'] for row in corpus]
+
+    # Zipf-like weights: the most common agent dominates real scan traffic
+    weights = [1 / (rank + 1) for rank in range(len(agents))]
+    rng = random.Random(42)
+    stream = rng.choices(agents, weights=weights, k=iterations)
+
+    print(f'Corpus: {len(corpus)} user agents, stream: {iterations} scans\n')
+    for label, func in [('legacy', legacy_classify),
+                        ('classify', new_classify)]:
+        scores = accuracy(corpus, func)
+        print(f'{label:>10}: device {scores["device_type"]:.0%}  '
+              f'browser {scores["browser"]:.0%}  os {scores["os"]:.0%}')
+
+    print()
+    classify.cache_clear()
+    print(f'{"legacy":>10}: {throughput(stream, legacy_classify):,.0f} UA/s')
+    print(f'{"classify":>10}: {throughput(stream, classify):,.0f} UA/s '
+          f'(memoized)')
+    uncached = classify.__wrapped__
+    print(f'{"classify":>10}: {throughput(stream, uncached):,.0f} UA/s '
+          f'(no cache)')
+
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,8 @@ class ScanAdmin(admin.ModelAdmin):
 
 @admin.register(BulkQRJob)
 class BulkQRJobAdmin(admin.ModelAdmin):
-    list_display = ['id', 'user', 'status', 'created_at', 'completed_at']
+    list_display = ['id', 'user', 'status', 'rows_processed', 'rows_failed',
+                    'rows_total', 'created_at', 'completed_at']
     list_filter = ['status', 'created_at']
-    readonly_fields = ['created_at', 'completed_at']
+    readonly_fields = ['created_at', 'completed_at', 'rows_total',
+                       'rows_processed', 'rows_failed']
@@ -0,0 +1,60 @@
+"""
+A compact Bloom filter.
+
+Used to answer "can this short URL exist?" without a database query. A
+negative answer is always correct; a positive answer is wrong with roughly
+the configured error rate.
+"""
+import hashlib
+import math
+
+
+class BloomFilter:
+    """Bloom filter over strings, sized for a capacity and error rate"""
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(int(capacity), 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(
+            int(-capacity * math.log(error_rate) / math.log(2) ** 2), 64)
+        self.num_hashes = max(
+            int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+    @property
+    def size_bytes(self):
+        return len(self.bits)
+
+    def false_positive_rate(self):
+        """Expected false positive rate for the items added so far"""
+        return (1 - math.exp(-self.num_hashes * self.count
+                             / self.num_bits)) ** self.num_hashes
+
+    def stats(self):
+        return {
+            'items': self.count,
+            'capacity': self.capacity,
+            'size_bytes': self.size_bytes,
+            'num_hashes': self.num_hashes,
+            'target_error_rate': self.error_rate,
+            'false_positive_rate': self.false_positive_rate(),
+        }
@@ -0,0 +1,261 @@
+"""
+Validation and normalization of bulk job CSVs.
+
+An uploaded CSV is checked before anything is rendered. It is read with
+pandas in chunks of CHUNK_ROWS records, and every column is checked and
+normalized with vectorized string operations:
+
+- name: trimmed, 'QR Code' when empty, cut to 200 characters
+- data / destination_url: a row needs one of them; a destination_url makes
+  a dynamic code and must be an http(s) or ftp(s) URL of at most 200
+  characters, and needs QR_PUBLIC_BASE_URL to be configured; data must fit
+  in a version 40 code at the row's error correction level
+- fill_color / back_color: '#RRGGBB' (the '#' is optional and 3-digit
+  shorthand is expanded); defaults when empty
+- error_correction: one of L, M, Q, H in any case; M when empty
+- size: a number, rounded and clamped to the form's 100-1000 px; 300 when
+  empty
+
+Valid rows are written to a normalized CSV with every column filled in, in
+canonical form; the render stage reads only that file. Each problem is
+written to an error report as (line, column, value, message), where line
+is the row's line in the upload (the header is line 1).
+
+The normalized CSV also plans the job's archive. Every row gets a unique
+file name (a repeated name becomes 'name (2).png', and so on), and a
+static row that renders exactly like an earlier row of the job names that
+row's file in duplicate_of, so its image is rendered only once.
+"""
+import csv
+import tempfile
+
+import pandas as pd
+from django.conf import settings
+from django.core.files import File
+from django.core.validators import URLValidator
+from qrcode import constants, util
+
+from . import encoder
+
+
+COLUMNS = ['name', 'data', 'destination_url', 'fill_color', 'back_color',
+           'error_correction', 'size']
+DEFAULTS = {
+    'name': 'QR Code',
+    'data': '',
+    'destination_url': '',
+    'fill_color': '#000000',
+    'back_color': '#FFFFFF',
+    'error_correction': 'M',
+    'size': '300',
+}
+REPORT_COLUMNS = ['line', 'column', 'value', 'message']
+# Normalized CSV: the canonical columns plus the archive plan
+PLAN_COLUMNS = COLUMNS + ['filename', 'duplicate_of']
+# Columns that determine a static row's image
+RENDER_COLUMNS = ['data', 'fill_color', 'back_color', 'error_correction',
+                  'size']
+
+# Records validated at a time
+CHUNK_ROWS = 10000
+
+# Limits of the QR code form and model fields
+MIN_SIZE, MAX_SIZE = 100, 1000
+MAX_NAME_LENGTH = 200
+MAX_URL_LENGTH = 200
+
+URL_RE = URLValidator.regex.pattern
+URL_SCHEME_RE = r'(?i)(?:https?|ftps?)://'
+HEX_COLOR_RE = r'#?[0-9A-Fa-f]{6}'
+SHORT_HEX_COLOR_RE = r'#?([0-9A-Fa-f])([0-9A-Fa-f])([0-9A-Fa-f])'
+ERROR_CORRECTION_LEVELS = ['L', 'M', 'Q', 'H']
+QR_ERROR_CORRECTION = {level: getattr(constants, f'ERROR_CORRECT_{level}')
+                       for level in ERROR_CORRECTION_LEVELS}
+# Data bits of a version 40 code per level, and the byte mode header
+MAX_DATA_BITS = {level: util.BIT_LIMIT_TABLE[value][40]
+                 for level, value in QR_ERROR_CORRECTION.items()}
+BYTE_HEADER_BITS = 4 + 16
+
+# Both the csv module and pandas write the files with these line endings
+LINE_TERMINATOR = '\r\n'
+
+
+def _column(frame, name):
+    """Trimmed column, or the default for every row if it is missing"""
+    if name not in frame:
+        return pd.Series(DEFAULTS[name], index=frame.index)
+    return frame[name].str.strip()
+
+
+def _color(values, default):
+    values = values.where(values != '', default)
+    values = values.str.replace(f'^{SHORT_HEX_COLOR_RE}$', r'\1\1\2\2\3\3',
+                                regex=True)
+    valid = values.str.fullmatch(HEX_COLOR_RE)
+    return '#' + values.str.lstrip('#').str.upper(), valid
+
+
+def normalize_chunk(frame, first_line):
+    """
+    Validate one chunk of records read as strings.
+
+    Returns (normalized, errors): the valid rows with every column in
+    canonical form, and the error report rows for this chunk.
+    """
+    lines = pd.Series(range(first_line, first_line + len(frame)),
+                      index=frame.index)
+    normalized = pd.DataFrame(index=frame.index)
+    problems = []
+
+    def check(valid, column, values, message):
+        failed = ~valid
+        if failed.any():
+            problems.append(pd.DataFrame({
+                'line': lines[failed], 'column': column,
+                'value': values[failed], 'message': message}))
+
+    name = _column(frame, 'name')
+    normalized['name'] = name.where(
+        name != '', DEFAULTS['name']).str.slice(0, MAX_NAME_LENGTH)
+
+    data = _column(frame, 'data')
+    url = _column(frame, 'destination_url')
+    dynamic = url != ''
+    check(dynamic | (data != ''), 'data', data,
+          'Either data or destination_url is required.')
+    check(~dynamic | (url.str.match(URL_SCHEME_RE)
+                      & url.str.fullmatch(URL_RE, case=False)
+                      & (url.str.len() <= MAX_URL_LENGTH)),
+          'destination_url', url,
+          f'Enter a valid URL of at most {MAX_URL_LENGTH} characters.')
+    if not settings.QR_PUBLIC_BASE_URL:
+        # Without a request, the redirect URL needs a configured origin
+        check(~dynamic, 'destination_url', url,
+              'Dynamic QR codes require QR_PUBLIC_BASE_URL to be set.')
+    # Dynamic codes encode their redirect URL, not data
+    normalized['data'] = data.where(~dynamic, '')
+    normalized['destination_url'] = url
+
+    for column in ('fill_color', 'back_color'):
+        raw = _column(frame, column)
+        normalized[column], valid = _color(raw, DEFAULTS[column])
+        check(valid, column, raw, 'Enter a hex color such as #1A2B3C.')
+
+    raw = _column(frame, 'error_correction')
+    level = raw.where(raw != '', DEFAULTS['error_correction']).str.upper()
+    check(level.isin(ERROR_CORRECTION_LEVELS), 'error_correction', raw,
+          'Use one of L, M, Q or H.')
+    normalized['error_correction'] = level
+
+    # Byte mode is the costliest encoding, so only data too long for it can
+    # overflow; those rows are measured exactly, segmented as the encoder
+    # does
+    bits = data.str.encode('utf-8').str.len() * 8 + BYTE_HEADER_BITS
+    long = ~dynamic & (bits > level.map(MAX_DATA_BITS))
+    fits = pd.Series(True, index=frame.index)
+    if long.any():
+        fits[long] = [encoder.fits(value, QR_ERROR_CORRECTION[ec])
+                      for value, ec in zip(data[long], level[long])]
+    check(fits, 'data', data,
+          'Too much data for a QR code at this error correction level.')
+
+    raw = _column(frame, 'size')
+    size = pd.to_numeric(raw.where(raw != '', DEFAULTS['size']),
+                         errors='coerce')
+    check(size.notna(), 'size', raw, 'Enter a number of pixels.')
+    normalized['size'] = size.round().clip(MIN_SIZE, MAX_SIZE)
+
+    if problems:
+        errors = pd.concat(problems)
+        normalized = normalized[~lines.isin(errors['line'])]
+        errors = errors.sort_values('line', kind='stable')
+    else:
+        errors = pd.DataFrame(columns=REPORT_COLUMNS)
+    normalized['size'] = normalized['size'].astype(int)
+    return normalized, errors
+
+
+class ArchivePlan:
+    """Archive file names and render deduplication across a job's rows"""
+
+    def __init__(self):
+        self.used = set()
+        # Last suffix handed out per name, so repeats are not rescanned
+        self.suffixes = {}
+        # Render parameters -> file name of the first row rendering them
+        self.rendered = {}
+
+    def filename(self, name):
+        """A file name not used yet; compared case-insensitively, since
+        archives are often extracted on case-insensitive file systems"""
+        key = name.casefold()
+        suffix = self.suffixes.get(key, 0)
+        while True:
+            suffix += 1
+            filename = (f'{name}.png' if suffix == 1
+                        else f'{name} ({suffix}).png')
+            if filename.casefold() not in self.used:
+                break
+        self.suffixes[key] = suffix
+        self.used.add(filename.casefold())
+        return filename
+
+    def add(self, normalized):
+        """Fill in the filename and duplicate_of columns of valid rows"""
+        render_keys = normalized[RENDER_COLUMNS[0]].str.cat(
+            [normalized[column].astype(str) for column in RENDER_COLUMNS[1:]],
+            sep='\0')
+        filenames, duplicates = [], []
+        for name, key, dynamic in zip(normalized['name'], render_keys,
+                                      normalized['destination_url'] != ''):
+            filename = self.filename(name)
+            filenames.append(filename)
+            if not dynamic and key in self.rendered:
+                duplicates.append(self.rendered[key])
+            else:
+                # Each dynamic code encodes its own short URL
+                if not dynamic:
+                    self.rendered[key] = filename
+                duplicates.append('')
+        normalized['filename'] = filenames
+        normalized['duplicate_of'] = duplicates
+        return normalized
+
+
+def validate_bulk_csv(job):
+    """
+    Validate a bulk job's upload into its normalized CSV and error report.
+
+    Saves both files on the job (without saving the job) and returns
+    (rows, invalid): the number of records and how many were rejected.
+    """
+    rows = invalid = 0
+    plan = ArchivePlan()
+    with job.file.open('rb') as upload, \
+            tempfile.TemporaryFile('w+', newline='') as normalized, \
+            tempfile.TemporaryFile('w+', newline='') as report:
+        # Every value is read as a string, blanks as ''
+        chunks = pd.read_csv(upload, dtype=str, keep_default_na=False,
+                             chunksize=CHUNK_ROWS, encoding='utf-8-sig',
+                             encoding_errors='replace')
+        csv.writer(normalized, lineterminator=LINE_TERMINATOR).writerow(
+            PLAN_COLUMNS)
+        csv.writer(report, lineterminator=LINE_TERMINATOR).writerow(
+            REPORT_COLUMNS)
+        for chunk in chunks:
+            clean, errors = normalize_chunk(chunk, rows + 2)
+            plan.add(clean)[PLAN_COLUMNS].to_csv(
+                normalized, header=False, index=False,
+                lineterminator=LINE_TERMINATOR)
+            errors.to_csv(report, header=False, index=False,
+                          lineterminator=LINE_TERMINATOR)
+            rows += len(chunk)
+            invalid += len(chunk) - len(clean)
+
+        normalized.seek(0)
+        job.normalized_file.save('normalized.csv', File(normalized),
+                                 save=False)
+        if invalid:
+            report.seek(0)
+            job.error_report.save('errors.csv', File(report), save=False)
+    return rows, invalid
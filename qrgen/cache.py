@@ -0,0 +1,316 @@
+"""
+Short URL resolution cache for the redirect hot path.
+
+Lookups go through a small per-process LRU first, then the shared Django
+cache, and only fall back to the database when both miss. Entries in the
+local LRU expire after a few seconds so that other processes pick up
+destination changes quickly; the process that made the change drops its
+own entry immediately through ``invalidate_short_url``. When the Django
+cache is per-process (LocMemCache, the default without REDIS_URL), an
+invalidation cannot reach other processes, so entries there are kept no
+longer than in the local LRU.
+
+Codes that cannot exist are rejected up front by ``ShortURLFilter`` and
+codes that were looked up and not found are cached as misses for a short
+time, so random codes from bots and scanners do not reach the database.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Min
+
+from .bloom import BloomFilter
+from .shortcodes import COUNTER_NAME, decode
+
+
+logger = logging.getLogger(__name__)
+
+
+ResolvedCode = namedtuple('ResolvedCode', ['pk', 'destination_url'])
+
+CACHE_KEY_PREFIX = 'qrgen:short_url:'
+
+# Cached marker for a short URL that does not exist
+MISSING = ()
+
+
+class LocalLRU:
+    """Thread-safe LRU with a per-entry time-to-live"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class ShortURLFilter:
+    """
+    Decides whether a short URL can belong to a live dynamic QR code.
+
+    Allocated codes decode to their counter value, and values at or above
+    the counter's high-water mark were never issued. The mark is re-read
+    only when a code is above it, at most once per
+    SHORT_URL_HIGH_WATER_REFRESH seconds.
+
+    A Bloom filter of all live codes is rebuilt in a background thread every
+    SHORT_URL_FILTER_REBUILD_INTERVAL seconds. It is authoritative for codes
+    that are not allocator codes (legacy random codes) and for allocated
+    codes below the counter value seen at an earlier build at least two
+    block lifetimes ago: any such code was saved before the current build
+    started, unless it is reserved (see reserved_short_urls in
+    qrgen.shortcodes), so trust also stops at the oldest open reservation.
+    Newer codes pass through to the normal lookup.
+    """
+
+    def __init__(self):
+        self.bloom = None
+        self.trusted_below = 0
+        self.built_at = None
+        self._snapshots = []
+        self._key = None
+        self._high_water = 0
+        self._high_water_checked = float('-inf')
+        self._building = False
+        self._lock = threading.Lock()
+
+    def _read_counter(self):
+        from .models import ShortCodeCounter
+
+        row = ShortCodeCounter.objects.filter(name=COUNTER_NAME).values_list(
+            'next_value', 'key').first()
+        return row or (0, '')
+
+    def refresh_high_water(self):
+        value, key = self._read_counter()
+        self._key = bytes.fromhex(key)
+        self._high_water = max(self._high_water, value)
+        self._high_water_checked = time.monotonic()
+
+    def check(self, short_url):
+        """
+        Return False if the code cannot exist, True if it might, or None if
+        the high-water mark must be refreshed before deciding.
+        """
+        self._maybe_rebuild()
+        if self._key is None:
+            return None
+
+        number = decode(short_url, self._key)
+        if number is not None:
+            if number >= self._high_water:
+                age = time.monotonic() - self._high_water_checked
+                if age > settings.SHORT_URL_HIGH_WATER_REFRESH:
+                    return None
+                return False
+            if number >= self.trusted_below:
+                return True
+
+        bloom = self.bloom
+        if bloom is None:
+            return True
+        return short_url in bloom
+
+    async def amight_exist(self, short_url):
+        result = self.check(short_url)
+        if result is None:
+            await sync_to_async(self.refresh_high_water)()
+            result = self.check(short_url)
+        return result
+
+    def add(self, short_url):
+        """Record a code created by this process"""
+        if self._key is not None:
+            number = decode(short_url, self._key)
+            if number is not None and number >= self._high_water:
+                self._high_water = number + 1
+        bloom = self.bloom
+        if bloom is not None:
+            bloom.add(short_url)
+
+    def _maybe_rebuild(self):
+        built_at = self.built_at
+        if built_at is not None and (time.monotonic() - built_at
+                                     < settings.SHORT_URL_FILTER_REBUILD_INTERVAL):
+            return
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+        threading.Thread(target=self._rebuild_in_thread,
+                         name='short-url-filter', daemon=True).start()
+
+    def _rebuild_in_thread(self):
+        try:
+            self.rebuild()
+        except Exception:
+            logger.exception('Short URL filter rebuild failed')
+            self.built_at = time.monotonic()
+        finally:
+            self._building = False
+            connection.close()
+
+    def rebuild(self):
+        """Rebuild the Bloom filter from the database"""
+        from .models import QRCode, ShortURLReservation
+
+        started = time.monotonic()
+        counter_value, key = self._read_counter()
+        # Read before the codes: a reservation released since then was
+        # committed first, so its codes are in the build
+        reserved_from = ShortURLReservation.objects.aggregate(
+            start=Min('start'))['start']
+
+        codes = QRCode.objects.filter(
+            qr_type='dynamic', short_url__isnull=False
+        ).values_list('short_url', flat=True)
+        bloom = BloomFilter(max(codes.count() * 1.25, 1000),
+                            settings.SHORT_URL_FILTER_ERROR_RATE)
+        for short_url in codes.iterator(chunk_size=10000):
+            bloom.add(short_url)
+
+        min_age = 2 * settings.SHORT_URL_BLOCK_TTL
+        trusted_below = max((value for taken, value in self._snapshots
+                             if started - taken >= min_age), default=0)
+        self._snapshots = [
+            (taken, value) for taken, value in self._snapshots
+            if started - taken < min_age or value == trusted_below
+        ] + [(started, counter_value)]
+
+        if reserved_from is not None:
+            trusted_below = min(trusted_below, reserved_from)
+
+        self._key = bytes.fromhex(key)
+        self._high_water = max(self._high_water, counter_value)
+        self._high_water_checked = started
+        self.bloom = bloom
+        self.trusted_below = trusted_below
+        self.built_at = started
+        logger.info('Short URL filter rebuilt: %s', self.stats())
+        return bloom
+
+    def stats(self):
+        stats = self.bloom.stats() if self.bloom is not None else {}
+        stats.update({
+            'trusted_below': self.trusted_below,
+            'high_water': self._high_water,
+        })
+        return stats
+
+
+_local = LocalLRU(settings.SHORT_URL_CACHE_SIZE,
+                  settings.SHORT_URL_CACHE_LOCAL_TTL)
+
+short_url_filter = ShortURLFilter()
+
+
+def _cache_key(short_url):
+    return CACHE_KEY_PREFIX + short_url
+
+
+def _fetch(short_url):
+    """Load a dynamic code's pk and destination from the database"""
+    from .models import QRCode
+
+    row = QRCode.objects.filter(
+        short_url=short_url, qr_type='dynamic'
+    ).values_list('pk', 'destination_url').first()
+    return ResolvedCode(*row) if row else None
+
+
+def _cache_is_shared():
+    """Whether the Django cache is shared between processes"""
+    backend = settings.CACHES['default']['BACKEND']
+    return not backend.endswith(('.LocMemCache', '.DummyCache'))
+
+
+def _cache_entry(resolved):
+    """Shared cache value and timeout for a lookup result or a miss"""
+    if resolved is None:
+        value, timeout = MISSING, settings.SHORT_URL_NEGATIVE_CACHE_TIMEOUT
+    else:
+        value, timeout = tuple(resolved), settings.SHORT_URL_CACHE_TIMEOUT
+    if not _cache_is_shared():
+        # Other processes' copies cannot be invalidated
+        timeout = min(timeout, settings.SHORT_URL_CACHE_LOCAL_TTL)
+    return value, timeout
+
+
+async def aresolve_short_url(short_url):
+    """
+    Resolve a short URL to its QR code pk and destination URL.
+
+    Returns a ResolvedCode, or None if no dynamic QR code uses this short URL.
+    """
+    resolved = _local.get(short_url)
+    if resolved is not None:
+        return resolved or None
+
+    if not await short_url_filter.amight_exist(short_url):
+        return None
+
+    cached = await cache.aget(_cache_key(short_url))
+    if cached is not None:
+        resolved = ResolvedCode(*cached) if cached else MISSING
+        _local.set(short_url, resolved)
+        return resolved or None
+
+    from .models import QRCode
+
+    row = await QRCode.objects.filter(
+        short_url=short_url, qr_type='dynamic'
+    ).values_list('pk', 'destination_url').afirst()
+    resolved = ResolvedCode(*row) if row else None
+    value, timeout = _cache_entry(resolved)
+    await cache.aset(_cache_key(short_url), value, timeout)
+    _local.set(short_url, resolved or MISSING)
+    return resolved
+
+
+def register_short_url(short_url):
+    """Make a newly saved code visible to this process's filter"""
+    if short_url:
+        short_url_filter.add(short_url)
+
+
+def invalidate_short_url(short_url):
+    """Drop a short URL (or a cached miss for it) from both cache tiers"""
+    if not short_url:
+        return
+    _local.delete(short_url)
+    cache.delete(_cache_key(short_url))
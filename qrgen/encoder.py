@@ -0,0 +1,331 @@
+"""
+QR code encoder working on NumPy arrays.
+
+Produces exactly the same modules, version and mask as
+``qrcode.QRCode.make(fit=True)``, which remains the reference. Splitting
+the data into segments is left to the qrcode package. The expensive steps
+are done here:
+
+- Reed-Solomon error correction uses a product table built from the
+  log/antilog tables, so each data byte costs one lookup and one XOR.
+- Function patterns and the zigzag data path are computed once per version,
+  so data placement is a single scatter into all eight masked candidates.
+- All eight masks are applied and scored together. Runs, 2x2 blocks,
+  finder-like patterns and dark ratio are counted with array operations.
+  The first mask with the lowest penalty wins, as in the reference.
+
+Data that does not fit in version 40 raises DataOverflowError, where the
+reference raises a plain ValueError for some inputs.
+"""
+from bisect import bisect_left
+from functools import lru_cache
+
+import numpy as np
+import qrcode
+from qrcode import base, util
+
+
+# GF(256) antilog (EXP) and log tables, shared with the reference encoder
+EXP = np.array(base.EXP_TABLE, dtype=np.uint8)
+LOG = np.array(base.LOG_TABLE, dtype=np.int32)
+
+# 1:1:3:1:1 finder-like patterns with four light modules on one side, as
+# 11-bit window codes
+FINDER_CODES = (0b10111010000, 0b00001011101)
+
+
+class _Bits:
+    """Minimal stand-in for qrcode.util.BitBuffer backed by one integer"""
+
+    def __init__(self):
+        self.value = 0
+        self.length = 0
+
+    def put(self, num, length):
+        self.value = (self.value << length) | (num & ((1 << length) - 1))
+        self.length += length
+
+    def __len__(self):
+        return self.length
+
+
+def _write_segments(data_list, mode_sizes):
+    buffer = _Bits()
+    for data in data_list:
+        buffer.put(data.mode, 4)
+        buffer.put(len(data), mode_sizes[data.mode])
+        if data.mode == util.MODE_8BIT_BYTE:
+            # Byte mode is the bytes themselves; skip the per-byte loop
+            buffer.put(int.from_bytes(data.data, 'big'), 8 * len(data.data))
+        else:
+            data.write(buffer)
+    return buffer
+
+
+def best_version(data_list, error_correction, start=1):
+    """Smallest version the segments fit in, as QRCode.best_fit"""
+    mode_sizes = util.mode_sizes_for_version(start)
+    needed_bits = len(_write_segments(data_list, mode_sizes))
+    version = bisect_left(util.BIT_LIMIT_TABLE[error_correction],
+                          needed_bits, start)
+    if version == 41:
+        raise qrcode.exceptions.DataOverflowError()
+    # Length fields grow with the version; retry if the guess was too low
+    if mode_sizes is not util.mode_sizes_for_version(version):
+        return best_version(data_list, error_correction, version)
+    return version
+
+
+def fits(data, error_correction):
+    """Whether data fits in a version 40 code, segmented as by encode"""
+    data_list = util.optimal_data_chunks(data, minimum=20)
+    needed_bits = len(_write_segments(data_list,
+                                      util.mode_sizes_for_version(40)))
+    return needed_bits <= util.BIT_LIMIT_TABLE[error_correction][40]
+
+
+@lru_cache(maxsize=None)
+def _generator_table(ec_count):
+    """
+    Products of the RS generator polynomial with every possible byte.
+
+    Entry f is f * g(x) without the leading term, packed big-endian into an
+    int, so one division step is ``shift(remainder) ^ table[feedback]``.
+    """
+    generator = [1]
+    for i in range(ec_count):
+        # Multiply by (x + alpha^i)
+        product = generator + [0]
+        for j, coefficient in enumerate(generator):
+            if coefficient:
+                product[j + 1] ^= int(EXP[(LOG[coefficient] + i) % 255])
+        generator = product
+    coefficients = np.array(generator[1:], dtype=np.int32)
+
+    table = np.zeros((256, ec_count), dtype=np.uint8)
+    nonzero = coefficients != 0
+    table[1:, nonzero] = EXP[(LOG[1:256, None] + LOG[coefficients[nonzero]])
+                             % 255]
+    return [int.from_bytes(row.tobytes(), 'big') for row in table]
+
+
+def _error_correction(block, ec_count):
+    """Reed-Solomon codewords for one block of data bytes"""
+    table = _generator_table(ec_count)
+    shift = 8 * (ec_count - 1)
+    keep = (1 << shift) - 1
+    remainder = 0
+    for byte in block:
+        remainder = ((remainder & keep) << 8) ^ table[(remainder >> shift)
+                                                      ^ byte]
+    return remainder.to_bytes(ec_count, 'big')
+
+
+def create_codewords(version, error_correction, data_list):
+    """Data and error correction codewords in transmission order"""
+    buffer = _write_segments(data_list, util.mode_sizes_for_version(version))
+
+    rs_blocks = base.rs_blocks(version, error_correction)
+    bit_limit = sum(block.data_count * 8 for block in rs_blocks)
+    if len(buffer) > bit_limit:
+        raise qrcode.exceptions.DataOverflowError(
+            'Code length overflow. Data size (%s) > size available (%s)'
+            % (len(buffer), bit_limit))
+
+    # Terminator, byte alignment, then alternating pad bytes
+    buffer.put(0, min(bit_limit - len(buffer), 4))
+    buffer.put(0, -len(buffer) % 8)
+    pad = (bit_limit - len(buffer)) // 8
+    data = bytearray(buffer.value.to_bytes(len(buffer) // 8, 'big'))
+    data += bytes([util.PAD0, util.PAD1]) * (pad // 2) + (
+        bytes([util.PAD0]) if pad % 2 else b'')
+
+    blocks, ec_blocks = [], []
+    offset = 0
+    for block in rs_blocks:
+        blocks.append(data[offset:offset + block.data_count])
+        ec_blocks.append(_error_correction(
+            blocks[-1], block.total_count - block.data_count))
+        offset += block.data_count
+
+    # Data codewords interleaved across blocks, then EC codewords
+    return np.concatenate([_interleave(blocks), _interleave(ec_blocks)])
+
+
+def _interleave(chunks):
+    """i-th byte of every chunk, for each i; chunks differ in length by 1"""
+    shortest = min(map(len, chunks))
+    columns = np.frombuffer(b''.join(chunk[:shortest] for chunk in chunks),
+                            dtype=np.uint8).reshape(len(chunks), shortest)
+    tails = bytes(chunk[shortest] for chunk in chunks if len(chunk) > shortest)
+    return np.concatenate([columns.T.ravel(),
+                           np.frombuffer(tails, dtype=np.uint8)])
+
+
+def _format_positions(count):
+    """Coordinates of the 15 format bits, both copies, in bit order"""
+    vertical = [(i, 8) if i < 6 else (i + 1, 8) if i < 8
+                else (count - 15 + i, 8) for i in range(15)]
+    horizontal = [(8, count - i - 1) if i < 8 else (8, 15 - i)
+                  if i < 9 else (8, 15 - i - 1) for i in range(15)]
+    return vertical, horizontal
+
+
+@lru_cache(maxsize=None)
+def _layout(version):
+    """
+    Function patterns and data path for a version.
+
+    Returns (template, rows, columns): template has function modules set
+    and format/version areas light, and (rows, columns) list the data
+    modules in placement order.
+    """
+    qr = qrcode.QRCode(version=version, border=0)
+    count = version * 4 + 17
+    qr.modules_count = count
+    qr.modules = [[None] * count for _ in range(count)]
+    qr.setup_position_probe_pattern(0, 0)
+    qr.setup_position_probe_pattern(count - 7, 0)
+    qr.setup_position_probe_pattern(0, count - 7)
+    qr.setup_position_adjust_pattern()
+    qr.setup_timing_pattern()
+    # Format and version areas are reserved with light modules, as in a test
+    # layout of the reference encoder
+    qr.setup_type_info(True, 0)
+    if version >= 7:
+        qr.setup_type_number(True)
+
+    reserved = np.array([[cell is not None for cell in row]
+                         for row in qr.modules])
+    template = np.array([[bool(cell) for cell in row] for row in qr.modules],
+                        dtype=np.uint8)
+
+    rows, columns = [], []
+    upward = True
+    for right in range(count - 1, 0, -2):
+        if right <= 6:
+            right -= 1
+        order = range(count - 1, -1, -1) if upward else range(count)
+        for row in order:
+            for column in (right, right - 1):
+                if not reserved[row][column]:
+                    rows.append(row)
+                    columns.append(column)
+        upward = not upward
+    return template, np.array(rows), np.array(columns)
+
+
+@lru_cache(maxsize=None)
+def _mask_bits(version):
+    """(8, modules) uint8 array: which data modules each mask inverts"""
+    _, rows, columns = _layout(version)
+    i, j = rows, columns
+    return np.array([
+        (i + j) % 2 == 0,
+        i % 2 == 0,
+        j % 3 == 0,
+        (i + j) % 3 == 0,
+        (i // 2 + j // 3) % 2 == 0,
+        (i * j) % 2 + (i * j) % 3 == 0,
+        ((i * j) % 2 + (i * j) % 3) % 2 == 0,
+        ((i * j) % 3 + (i + j) % 2) % 2 == 0,
+    ], dtype=np.uint8)
+
+
+def _run_penalty(lines):
+    """Rule 1 along rows: each run of 5 or more scores its length - 2"""
+    matrices, count, _ = lines.shape
+    bounded = np.full((matrices, count, count + 2), 2, dtype=np.uint8)
+    bounded[:, :, 1:-1] = lines
+    # Changes mark each run start plus the end of each row. A row's end and
+    # the next row's start are one apart, which reads as a run of 1
+    starts = np.flatnonzero(bounded[:, :, 1:] != bounded[:, :, :-1])
+    lengths = np.diff(starts)
+    owners = starts[:-1] // (count * (count + 1))
+    long_runs = lengths >= 5
+    return np.bincount(owners[long_runs], weights=lengths[long_runs] - 2,
+                       minlength=matrices).astype(np.int64)
+
+
+def _finder_penalty(lines):
+    """Rule 3 along rows: 40 per finder-like pattern"""
+    windows = lines.shape[-1] - 10
+    codes = np.zeros(lines.shape[:2] + (windows,), dtype=np.uint16)
+    for offset in range(11):
+        codes <<= 1
+        codes |= lines[:, :, offset:offset + windows]
+    matches = (codes == FINDER_CODES[0]) | (codes == FINDER_CODES[1])
+    return matches.sum(axis=(1, 2)) * 40
+
+
+def penalties(candidates):
+    """Penalty score of each matrix in a (masks, n, n) array"""
+    masks, count, _ = candidates.shape
+    # Rows of every candidate followed by its columns
+    lines = np.concatenate([candidates, candidates.transpose(0, 2, 1)])
+
+    line_scores = _run_penalty(lines) + _finder_penalty(lines)
+    scores = line_scores[:masks] + line_scores[masks:]
+
+    top_left = candidates[:, :-1, :-1]
+    block = ((top_left == candidates[:, :-1, 1:])
+             & (top_left == candidates[:, 1:, :-1])
+             & (top_left == candidates[:, 1:, 1:]))
+    scores += block.sum(axis=(1, 2)) * 3
+
+    # Same float arithmetic as the reference so ties resolve identically
+    for mask, dark in enumerate(candidates.sum(axis=(1, 2)).tolist()):
+        percent = float(dark) / (count ** 2)
+        scores[mask] += int(abs(percent * 100 - 50) / 5) * 10
+    return scores
+
+
+def _set_format(modules, version, error_correction, mask):
+    count = len(modules)
+    bits = util.BCH_type_info((error_correction << 3) | mask)
+    vertical, horizontal = _format_positions(count)
+    for i in range(15):
+        dark = (bits >> i) & 1
+        modules[vertical[i]] = dark
+        modules[horizontal[i]] = dark
+    modules[count - 8, 8] = 1
+
+    if version >= 7:
+        bits = util.BCH_type_number(version)
+        for i in range(18):
+            dark = (bits >> i) & 1
+            modules[i // 3, i % 3 + count - 11] = dark
+            modules[i % 3 + count - 11, i // 3] = dark
+
+
+def encode(data, error_correction=qrcode.constants.ERROR_CORRECT_M,
+           version=1):
+    """
+    Encode data like ``QRCode(version=version).make(fit=True)``.
+
+    Returns (modules, version, mask) where modules is a uint8 array, 1 for
+    dark, without the quiet zone.
+    """
+    if isinstance(data, util.QRData):
+        data_list = [data]
+    else:
+        # Same segmentation as QRCode.add_data
+        data_list = list(util.optimal_data_chunks(data, minimum=20))
+    version = best_version(data_list, error_correction, version)
+
+    codewords = create_codewords(version, error_correction, data_list)
+    template, rows, columns = _layout(version)
+    bits = np.zeros(len(rows), dtype=np.uint8)
+    data_bits = np.unpackbits(codewords)[:len(rows)]
+    bits[:len(data_bits)] = data_bits
+
+    masked = bits ^ _mask_bits(version)
+    candidates = np.repeat(template[None], 8, axis=0)
+    candidates[:, rows, columns] = masked
+
+    scores = penalties(candidates)
+    mask = int(np.argmin(scores))
+
+    modules = candidates[mask]
+    _set_format(modules, version, error_correction, mask)
+    return modules, version, mask
@@ -0,0 +1,104 @@
+"""
+IP geolocation for scan analytics.
+
+Reads a MaxMind-format City (or Country) database from ``GEOIP_DATABASE``.
+The file is opened once per process with memory-mapped reads, and country
+and city come from the same record, so each scan costs at most one tree
+walk. Results are cached per /24 (IPv4) or /48 (IPv6) network, or per
+address when the database has a finer-grained network for it.
+"""
+import ipaddress
+import logging
+import os
+import threading
+from collections import namedtuple
+
+from django.conf import settings
+
+from .cache import LocalLRU
+
+
+logger = logging.getLogger(__name__)
+
+Location = namedtuple('Location', ['country', 'city'])
+
+UNKNOWN = Location('Unknown', 'Unknown')
+
+_reader = None
+_reader_pid = None
+_reader_lock = threading.Lock()
+
+_cache = LocalLRU(settings.GEOIP_CACHE_SIZE, float('inf'))
+
+
+def get_reader():
+    """Open the GeoIP database for this process, or return None if missing"""
+    global _reader, _reader_pid
+
+    if _reader_pid == os.getpid():
+        return _reader
+    with _reader_lock:
+        if _reader_pid != os.getpid():
+            _reader = None
+            path = settings.GEOIP_DATABASE
+            if path and os.path.exists(path):
+                import maxminddb
+
+                try:
+                    # MODE_AUTO memory-maps the file, using the C reader
+                    # when the extension is installed
+                    _reader = maxminddb.open_database(
+                        str(path), maxminddb.MODE_AUTO)
+                except (OSError, maxminddb.InvalidDatabaseError):
+                    logger.exception('Could not open GeoIP database %s', path)
+            _reader_pid = os.getpid()
+    return _reader
+
+
+def _name(record, key):
+    try:
+        return record[key]['names']['en']
+    except (KeyError, TypeError):
+        return 'Unknown'
+
+
+def _network_key(ip_address):
+    """Cache key for the /24 or /48 network, without parsing IPv4 addresses"""
+    if ':' not in ip_address:
+        return ip_address.rpartition('.')[0] + '/24'
+    try:
+        address = ipaddress.IPv6Address(ip_address)
+    except ValueError:
+        return None
+    return format(int(address) >> 80, 'x') + '/48'
+
+
+def lookup(ip_address):
+    """Return the Location (country, city) for an IP address"""
+    network_key = _network_key(ip_address)
+    location = _cache.get(network_key) or _cache.get(ip_address)
+    if location is not None:
+        return location
+
+    try:
+        address = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return UNKNOWN
+
+    reader = get_reader()
+    if reader is None:
+        return UNKNOWN
+
+    record, prefix_len = reader.get_with_prefix_len(address)
+    if record:
+        location = Location(_name(record, 'country'), _name(record, 'city'))
+    else:
+        location = UNKNOWN
+
+    # Share the result across the network unless the database splits it
+    # into smaller networks
+    if prefix_len <= (24 if address.version == 4 else 48):
+        _cache.set(network_key, location)
+    else:
+        _cache.set(ip_address, location)
+    return location
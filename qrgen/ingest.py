@@ -0,0 +1,311 @@
+"""
+Buffered scan ingestion.
+
+The redirect view only appends a compact scan record to a buffer; a flusher
+drains the buffer in batches, enriches the records (device, browser, OS,
+location) and writes them with a single ``bulk_create`` per batch.
+
+Two buffers are available, selected with ``SCAN_BUFFER_BACKEND``:
+
+- ``local``: an in-process queue drained by a background thread
+- ``redis``: a Redis list drained by the ``flush_scan_buffer`` Celery task
+
+``direct`` disables buffering and writes every scan synchronously. When a
+buffer is full or Redis is unreachable the scan is written directly instead,
+so no scan is dropped.
+"""
+import abc
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import (
+    InterfaceError, OperationalError, close_old_connections, transaction)
+
+from . import geoip
+from .useragent import classify
+
+
+logger = logging.getLogger(__name__)
+
+
+def make_record(qr_code_id, ip_address, user_agent):
+    """Build the compact record stored in the buffer"""
+    return (str(qr_code_id), ip_address, user_agent, time.time())
+
+
+def build_scan(record):
+    """Turn a buffered record into an unsaved Scan with analytics fields"""
+    from .models import Scan
+    qr_code_id, ip_address, user_agent, timestamp = record
+    agent = classify(user_agent)
+    location = geoip.lookup(ip_address)
+    return Scan(
+        qr_code_id=qr_code_id,
+        ip_address=ip_address,
+        user_agent=user_agent,
+        country=location.country,
+        city=location.city,
+        device_type=agent.device_type,
+        browser=agent.browser,
+        os=agent.os,
+        scanned_at=datetime.fromtimestamp(timestamp, tz=dt_timezone.utc),
+    )
+
+
+def write_scans(records):
+    """Persist a batch of records with one INSERT"""
+    from .models import QRCode, Scan
+
+    if not records:
+        return 0
+    # Codes deleted since the scan was buffered would fail the whole batch
+    live = {str(pk) for pk in QRCode.objects.filter(
+        pk__in={record[0] for record in records}).values_list('pk', flat=True)}
+    scans = [build_scan(record) for record in records if record[0] in live]
+    Scan.objects.bulk_create(scans, batch_size=settings.SCAN_BUFFER_FLUSH_SIZE)
+    return len(scans)
+
+
+class ScanBuffer(abc.ABC):
+    """Interface shared by the scan buffers"""
+
+    @abc.abstractmethod
+    def append(self, record):
+        """Queue a record; return False if the caller must write it itself"""
+
+    async def aappend(self, record):
+        """Async append; network-backed buffers push from a worker thread"""
+        return await sync_to_async(self.append, thread_sensitive=False)(record)
+
+    @abc.abstractmethod
+    def drain(self, limit):
+        """Remove and return up to ``limit`` records"""
+
+    @abc.abstractmethod
+    def requeue(self, records):
+        """Put records that failed to flush back at the head of the buffer"""
+
+    def flush(self, max_batches=None):
+        """
+        Drain the buffer in batches and write them. Returns rows written.
+
+        If the database is unreachable the batch is put back for the next
+        flush. Any other error is taken to come from a bad record, which
+        fails the whole INSERT: the batch is then written one record at a
+        time, and records that still fail are logged and dropped so they
+        cannot block the buffer.
+        """
+        written = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            records = self.drain(settings.SCAN_BUFFER_FLUSH_SIZE)
+            if not records:
+                break
+            try:
+                written += write_scans(records)
+            except (OperationalError, InterfaceError):
+                logger.exception('Failed to flush %d scans', len(records))
+                self.requeue(records)
+                break
+            except Exception:
+                logger.exception('Failed to flush %d scans, writing them '
+                                 'one by one', len(records))
+                count, unwritten = self._write_each(records)
+                written += count
+                if unwritten:
+                    self.requeue(unwritten)
+                    break
+            batches += 1
+        return written
+
+    def _write_each(self, records):
+        """
+        Write records singly, dropping the ones that fail. Returns (rows
+        written, records left unwritten because the database went away).
+        """
+        written = 0
+        for index, record in enumerate(records):
+            try:
+                with transaction.atomic():
+                    written += write_scans([record])
+            except (OperationalError, InterfaceError):
+                logger.exception('Failed to flush %d scans',
+                                 len(records) - index)
+                return written, records[index:]
+            except Exception:
+                logger.exception('Dropping scan record %r', record)
+        return written, []
+
+
+class DirectScanBuffer(ScanBuffer):
+    """No buffering: every record is written by the caller"""
+
+    def append(self, record):
+        return False
+
+    async def aappend(self, record):
+        return False
+
+    def drain(self, limit):
+        return []
+
+    def requeue(self, records):
+        write_scans(records)
+
+
+class LocalScanBuffer(ScanBuffer):
+    """In-process buffer flushed by a daemon thread"""
+
+    def __init__(self, max_size, flush_size, flush_interval):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._records = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._records)
+
+    def append(self, record):
+        with self._lock:
+            if len(self._records) >= self.max_size:
+                return False
+            self._records.append(record)
+            size = len(self._records)
+        if self._thread is None:
+            self._start()
+        if size >= self.flush_size:
+            self._wakeup.set()
+        return True
+
+    async def aappend(self, record):
+        # Only takes a lock around a deque append, safe on the event loop
+        return self.append(record)
+
+    def drain(self, limit):
+        with self._lock:
+            count = min(limit, len(self._records))
+            return [self._records.popleft() for _ in range(count)]
+
+    def requeue(self, records):
+        with self._lock:
+            self._records.extendleft(reversed(records))
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='scan-flusher', daemon=True)
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Scan flusher failed')
+
+
+class RedisScanBuffer(ScanBuffer):
+    """Buffer kept in a Redis list and drained by a Celery task"""
+
+    # Push only while the list is below its size limit, in one round trip
+    PUSH_SCRIPT = """
+    local size = redis.call('LLEN', KEYS[1])
+    if size >= tonumber(ARGV[2]) then
+        return -1
+    end
+    return redis.call('RPUSH', KEYS[1], ARGV[1])
+    """
+
+    def __init__(self, url, key, max_size, flush_size):
+        import redis
+
+        self.key = key
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.client = redis.Redis.from_url(
+            url, socket_timeout=0.25, socket_connect_timeout=0.25)
+        self._push = self.client.register_script(self.PUSH_SCRIPT)
+
+    def __len__(self):
+        return self.client.llen(self.key)
+
+    def append(self, record):
+        try:
+            size = self._push(keys=[self.key],
+                              args=[json.dumps(record), self.max_size])
+        except Exception as e:
+            logger.warning('Scan buffer unavailable, writing directly: %s', e)
+            return False
+        if size < 0:
+            return False
+        if size % self.flush_size == 0:
+            self._schedule_flush()
+        return True
+
+    def _schedule_flush(self):
+        from .tasks import flush_scan_buffer
+
+        try:
+            flush_scan_buffer.delay()
+        except Exception:
+            logger.warning('Could not schedule scan flush', exc_info=True)
+
+    def drain(self, limit):
+        pipe = self.client.pipeline()
+        pipe.lrange(self.key, 0, limit - 1)
+        pipe.ltrim(self.key, limit, -1)
+        items, _ = pipe.execute()
+        return [tuple(json.loads(item)) for item in items]
+
+    def requeue(self, records):
+        self.client.lpush(self.key,
+                          *[json.dumps(record) for record in reversed(records)])
+
+
+_buffer = None
+_buffer_pid = None
+
+
+def get_scan_buffer():
+    """Return this process's scan buffer, creating it after a fork"""
+    global _buffer, _buffer_pid
+
+    if _buffer is None or _buffer_pid != os.getpid():
+        backend = settings.SCAN_BUFFER_BACKEND
+        if backend == 'local':
+            _buffer = LocalScanBuffer(settings.SCAN_BUFFER_MAX_SIZE,
+                                      settings.SCAN_BUFFER_FLUSH_SIZE,
+                                      settings.SCAN_BUFFER_FLUSH_INTERVAL)
+        elif backend == 'redis':
+            _buffer = RedisScanBuffer(settings.SCAN_BUFFER_REDIS_URL,
+                                      settings.SCAN_BUFFER_KEY,
+                                      settings.SCAN_BUFFER_MAX_SIZE,
+                                      settings.SCAN_BUFFER_FLUSH_SIZE)
+        else:
+            _buffer = DirectScanBuffer()
+        _buffer_pid = os.getpid()
+    return _buffer
+
+
+async def arecord_scan(qr_code_id, ip_address, user_agent):
+    """Queue a scan, falling back to a direct write if the buffer refuses it"""
+    record = make_record(qr_code_id, ip_address, user_agent)
+    if not await get_scan_buffer().aappend(record):
+        await sync_to_async(write_scans)([record])
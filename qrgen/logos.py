@@ -0,0 +1,83 @@
+"""
+Logo preparation for QR code rendering.
+
+Uploaded logos can be multi-megabyte photos, while a rendered logo is at
+most a quarter of a 1000px code. ``prepare_logo`` runs once when a QRCode
+is saved: it decodes the upload (asking JPEG for a reduced-resolution
+decode where possible), converts it to RGBA and shrinks it to
+``LOGO_WORKING_SIZE``. The result is stored next to the original as a PNG.
+
+``logo_bitmap`` turns a stored logo into the exact bitmap pasted on a code
+of a given size. Bitmaps are kept in a per-process LRU keyed by file name
+and target size, so repeated renders only paste.
+"""
+import io
+
+from django.conf import settings
+from django.core.files import File
+from PIL import Image
+
+from .cache import LocalLRU
+
+
+# Fraction of the QR code width covered by the logo
+LOGO_SCALE = 0.25
+
+_bitmaps = LocalLRU(settings.LOGO_CACHE_SIZE, float('inf'))
+
+
+def logo_pixels(qr_size):
+    """Width and height in pixels of the logo on a code of qr_size"""
+    return max(int(qr_size * LOGO_SCALE), 1)
+
+
+def prepare_logo(logo):
+    """
+    Normalize an uploaded logo.
+
+    Returns PNG bytes of an RGBA image no larger than LOGO_WORKING_SIZE on
+    either side, keeping the aspect ratio.
+    """
+    working_size = settings.LOGO_WORKING_SIZE
+    logo.seek(0)
+    with Image.open(logo) as img:
+        # JPEG can decode at 1/2, 1/4 or 1/8 scale directly
+        img.draft('RGB', (working_size, working_size))
+        img.load()
+        if img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            # Palette and other modes cannot be resampled smoothly
+            img = img.convert('RGBA')
+        # Shrink before converting so the full-size copy is never RGBA
+        img.thumbnail((working_size, working_size), Image.Resampling.LANCZOS)
+        img = img.convert('RGBA')
+    # Leave the upload readable for the storage backend
+    logo.seek(0)
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def _resize(img, qr_size):
+    logo_size = logo_pixels(qr_size)
+    if img.mode != 'RGBA':
+        img = img.convert('RGBA')
+    return img.resize((logo_size, logo_size), Image.Resampling.LANCZOS)
+
+
+def logo_bitmap(logo, qr_size):
+    """
+    Return the RGBA bitmap to paste on a code of qr_size pixels.
+
+    ``logo`` is a stored file (ideally the prepared logo) or a PIL image.
+    """
+    if not isinstance(logo, File):
+        return _resize(logo, qr_size)
+
+    key = (logo.name, qr_size)
+    bitmap = _bitmaps.get(key)
+    if bitmap is None:
+        with logo.open('rb'), Image.open(logo) as img:
+            img.draft('RGB', (settings.LOGO_WORKING_SIZE,) * 2)
+            bitmap = _resize(img, qr_size)
+        _bitmaps.set(key, bitmap)
+    return bitmap
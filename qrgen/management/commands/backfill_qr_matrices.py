@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from qrgen.models import QRCode
+
+
+class Command(BaseCommand):
+    help = 'Encode and store the module matrix of existing QR codes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Rows updated per query')
+        parser.add_argument('--all', action='store_true',
+                            help='Check every row, not only rows without a '
+                                 'stored matrix')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        queryset = QRCode.objects.all()
+        if not options['all']:
+            queryset = queryset.filter(matrix_key='')
+
+        fields = ['matrix', 'matrix_version', 'matrix_mask', 'matrix_key']
+        checked = updated = 0
+        batch = []
+        for qr in queryset.iterator(chunk_size=batch_size):
+            checked += 1
+            if qr.update_matrix():
+                batch.append(qr)
+            if len(batch) >= batch_size:
+                QRCode.objects.bulk_update(batch, fields)
+                updated += len(batch)
+                batch = []
+        if batch:
+            QRCode.objects.bulk_update(batch, fields)
+            updated += len(batch)
+
+        self.stdout.write(f'Checked {checked} QR codes, stored {updated} matrices')
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from qrgen.render_cache import render_cache
+
+
+class Command(BaseCommand):
+    help = 'Show render cache disk usage or purge cached images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--purge', metavar='QR_ID', action='append',
+                            default=[], help='Purge cached images of a QR code')
+        parser.add_argument('--evict', action='store_true',
+                            help='Evict old entries down to the size limit')
+
+    def handle(self, *args, **options):
+        for pk in options['purge']:
+            render_cache.purge(pk)
+            self.stdout.write(f'Purged {pk}')
+        if options['evict']:
+            render_cache.evict()
+
+        if render_cache.directory is None:
+            return
+        files = list(render_cache.disk_entries()) if render_cache.directory.exists() else []
+        total = sum(size for _, size, _ in files)
+        self.stdout.write(f'directory: {render_cache.directory}')
+        self.stdout.write(f'entries: {len(files)}')
+        self.stdout.write(
+            f'size: {total} / {render_cache.disk_bytes} bytes')
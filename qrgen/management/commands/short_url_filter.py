@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from qrgen.cache import ShortURLFilter
+
+
+class Command(BaseCommand):
+    help = 'Build the short URL membership filter and print its size and error rate'
+
+    def handle(self, *args, **options):
+        short_url_filter = ShortURLFilter()
+        short_url_filter.rebuild()
+        for name, value in short_url_filter.stats().items():
+            self.stdout.write(f'{name}: {value}')
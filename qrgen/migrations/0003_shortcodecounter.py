@@ -0,0 +1,21 @@
+# Generated by Django 4.2.7 on 2026-10-18 08:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0002_scan_scanned_at_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShortCodeCounter',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('next_value', models.BigIntegerField(default=0)),
+                ('key', models.CharField(blank=True, default='', max_length=64)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 08:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0003_shortcodecounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qrcode',
+            name='logo_prepared',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='logos/prepared/'),
+        ),
+    ]
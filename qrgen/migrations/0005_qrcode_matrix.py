@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-18 08:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0004_qrcode_logo_prepared'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qrcode',
+            name='matrix',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='qrcode',
+            name='matrix_key',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='qrcode',
+            name='matrix_mask',
+            field=models.PositiveSmallIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='qrcode',
+            name='matrix_version',
+            field=models.PositiveSmallIntegerField(editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0005_qrcode_matrix'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulkqrjob',
+            name='rows_failed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='bulkqrjob',
+            name='rows_processed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='bulkqrjob',
+            name='rows_total',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0006_bulkqrjob_progress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkJobBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.PositiveIntegerField()),
+                ('stop', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='bulkqrjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='qrcode',
+            name='bulk_job',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='qr_codes', to='qrgen.bulkqrjob'),
+        ),
+        migrations.AddField(
+            model_name='qrcode',
+            name='bulk_row',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='qrcode',
+            constraint=models.UniqueConstraint(fields=('bulk_job', 'bulk_row'), name='unique_bulk_row'),
+        ),
+        migrations.AddField(
+            model_name='bulkjobbatch',
+            name='job',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='batches', to='qrgen.bulkqrjob'),
+        ),
+        migrations.AddConstraint(
+            model_name='bulkjobbatch',
+            constraint=models.UniqueConstraint(fields=('job', 'start'), name='unique_bulk_job_batch'),
+        ),
+    ]
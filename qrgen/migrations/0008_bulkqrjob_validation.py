@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0007_bulk_checkpoints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulkqrjob',
+            name='error_report',
+            field=models.FileField(blank=True, editable=False, null=True, upload_to='bulk_results/errors/'),
+        ),
+        migrations.AddField(
+            model_name='bulkqrjob',
+            name='normalized_file',
+            field=models.FileField(blank=True, editable=False, null=True, upload_to='bulk_csv/normalized/'),
+        ),
+    ]
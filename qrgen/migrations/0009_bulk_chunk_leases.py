@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0008_bulkqrjob_validation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulkjobbatch',
+            name='archive',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.CreateModel(
+            name='BulkJobChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.PositiveIntegerField()),
+                ('task_id', models.CharField(max_length=255)),
+                ('heartbeat_at', models.DateTimeField()),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='qrgen.bulkqrjob')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='bulkjobchunk',
+            constraint=models.UniqueConstraint(fields=('job', 'start'), name='unique_bulk_job_chunk'),
+        ),
+    ]
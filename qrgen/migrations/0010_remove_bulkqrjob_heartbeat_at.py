@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 10:08
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qrgen', '0009_bulk_chunk_leases'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='bulkqrjob',
+            name='heartbeat_at',
+        ),
+    ]
@@ -3,7 +3,18 @@ from django.contrib.auth.models import AbstractUser
 from django.urls import reverse
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.conf import settings
+from django.utils import timezone
+import os
 import uuid
+from qrcode.exceptions import DataOverflowError
+
+from .cache import invalidate_short_url, register_short_url
+from .logos import prepare_logo
+from .render_cache import render_cache
+from .shortcodes import allocate_short_url
+from .utils import encode_qr, matrix_key, pack_modules, unpack_modules
 
 
 class User(AbstractUser):
@@ -43,12 +54,34 @@ class QRCode(models.Model):
 
     # Logo
     logo = models.ImageField(upload_to='logos/', null=True, blank=True)
+    # RGBA copy of the logo shrunk to a working size, made on upload
+    logo_prepared = models.ImageField(
+        upload_to='logos/prepared/', null=True, blank=True, editable=False)
+
+    # Encoded payload, bit-packed without the quiet zone, so renders skip
+    # version selection, error correction and masking
+    matrix = models.BinaryField(null=True, editable=False)
+    matrix_version = models.PositiveSmallIntegerField(null=True, editable=False)
+    matrix_mask = models.PositiveSmallIntegerField(null=True, editable=False)
+    matrix_key = models.CharField(
+        max_length=64, blank=True, default='', editable=False)
+
+    # Bulk job and CSV record this code was generated from; the pair is
+    # unique so a resumed job never inserts a row twice
+    bulk_job = models.ForeignKey(
+        'BulkQRJob', on_delete=models.SET_NULL, null=True, blank=True,
+        editable=False, related_name='qr_codes')
+    bulk_row = models.PositiveIntegerField(null=True, editable=False)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(fields=['bulk_job', 'bulk_row'],
+                                    name='unique_bulk_row'),
+        ]
 
     def __str__(self):
         return self.name
@@ -59,27 +92,82 @@ class QRCode(models.Model):
     def save(self, *args, **kwargs):
         if not self.short_url and self.qr_type == 'dynamic':
             self.short_url = self.generate_short_url()
+        if self.logo and not self.logo._committed:
+            # A new upload: normalize it once instead of on every render
+            name = os.path.splitext(os.path.basename(self.logo.name))[0]
+            self.logo_prepared.save(f'{name}.png',
+                                    ContentFile(prepare_logo(self.logo)),
+                                    save=False)
+        elif not self.logo:
+            self.logo_prepared = None
+        self.update_matrix()
         super().save(*args, **kwargs)
+        invalidate_short_url(self.short_url)
+        render_cache.purge(self.pk)
+        if self.qr_type == 'dynamic':
+            register_short_url(self.short_url)
+
+    def delete(self, *args, **kwargs):
+        short_url = self.short_url
+        pk = self.pk
+        result = super().delete(*args, **kwargs)
+        invalidate_short_url(short_url)
+        render_cache.purge(pk)
+        return result
 
     def generate_short_url(self):
         """Generate a unique short URL"""
-        import random
-        import string
-        while True:
-            short = ''.join(random.choices(
-                string.ascii_letters + string.digits, k=8))
-            if not QRCode.objects.filter(short_url=short).exists():
-                return short
+        return allocate_short_url()
 
     def get_scan_count(self):
         """Get total scan count for this QR code"""
         return self.scans.count()
 
+    def update_matrix(self):
+        """
+        Encode the payload into the matrix fields if it changed.
+
+        Dynamic codes are only pre-encoded when QR_PUBLIC_BASE_URL is set;
+        otherwise their payload depends on the request host.
+        """
+        payload = self.get_data_url()
+        if not payload or payload.startswith('/'):
+            self.matrix = self.matrix_version = self.matrix_mask = None
+            self.matrix_key = ''
+            return False
+        key = matrix_key(payload, self.error_correction)
+        if key == self.matrix_key:
+            return False
+        try:
+            encoded = encode_qr(payload, self.error_correction)
+        except DataOverflowError:
+            # Too long to encode; rendering will report the error
+            self.matrix = self.matrix_version = self.matrix_mask = None
+            self.matrix_key = ''
+            return False
+        self.matrix = pack_modules(encoded.modules)
+        self.matrix_version = encoded.version
+        self.matrix_mask = encoded.mask
+        self.matrix_key = key
+        return True
+
+    def stored_modules(self, payload):
+        """Stored matrix if it encodes payload, else None"""
+        if (self.matrix is None
+                or self.matrix_key != matrix_key(payload,
+                                                 self.error_correction)):
+            return None
+        return unpack_modules(self.matrix, self.matrix_version)
+
     def get_data_url(self, request=None):
         """Get the data URL for this QR code"""
         if self.qr_type == 'static':
             return self.data
         else:
+            if settings.QR_PUBLIC_BASE_URL:
+                # A fixed origin keeps the encoded payload stable
+                return (f"{settings.QR_PUBLIC_BASE_URL}"
+                        f"/redirect/{self.short_url}/")
             # Use the request host dynamically so it works anywhere
             if request:
                 host = request.get_host()
@@ -101,12 +189,34 @@ class Scan(models.Model):
     device_type = models.CharField(max_length=50, null=True, blank=True)
     browser = models.CharField(max_length=100, null=True, blank=True)
     os = models.CharField(max_length=100, null=True, blank=True)
-    scanned_at = models.DateTimeField(auto_now_add=True)
+    # Set from the buffered scan record, not at insert time
+    scanned_at = models.DateTimeField(default=timezone.now, editable=False)
 
     class Meta:
         ordering = ['-scanned_at']
 
 
+class ShortCodeCounter(models.Model):
+    """Counter that short URL codes are allocated from in blocks"""
+    name = models.CharField(max_length=50, primary_key=True)
+    next_value = models.BigIntegerField(default=0)
+    # Hex key for the code scrambling permutation; empty means sequential
+    key = models.CharField(max_length=64, blank=True, default='')
+
+    def __str__(self):
+        return self.name
+
+
+class ShortURLReservation(models.Model):
+    """
+    Codes allocated for rows that are saved only after slow work, such as
+    rendering a bulk batch. While it exists, ShortURLFilter trusts no
+    counter value at or above ``start``.
+    """
+    start = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
 class BulkQRJob(models.Model):
     """Model to track bulk QR code generation jobs"""
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -118,10 +228,70 @@ class BulkQRJob(models.Model):
         ('failed', 'Failed')
     ], default='pending')
     file = models.FileField(upload_to='bulk_csv/')
+    # Valid rows of the upload in canonical form, and one line per rejected
+    # value (see qrgen.bulkcsv)
+    normalized_file = models.FileField(
+        upload_to='bulk_csv/normalized/', null=True, blank=True,
+        editable=False)
+    error_report = models.FileField(
+        upload_to='bulk_results/errors/', null=True, blank=True,
+        editable=False)
     result = models.FileField(upload_to='bulk_results/', null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     completed_at = models.DateTimeField(null=True, blank=True)
     error_message = models.TextField(null=True, blank=True)
 
+    # Progress, updated once per batch of rows
+    rows_total = models.PositiveIntegerField(null=True, blank=True)
+    rows_processed = models.PositiveIntegerField(default=0)
+    rows_failed = models.PositiveIntegerField(default=0)
+
     class Meta:
         ordering = ['-created_at']
+
+
+class BulkJobBatch(models.Model):
+    """
+    Checkpoint for a persisted batch of bulk job rows.
+
+    Written in the same transaction as the batch's QR codes and progress
+    counters. A batch with a checkpoint and a stored partial archive is
+    skipped when the job is resumed.
+    """
+    job = models.ForeignKey(
+        BulkQRJob, on_delete=models.CASCADE, related_name='batches')
+    # CSV records [start, stop)
+    start = models.PositiveIntegerField()
+    stop = models.PositiveIntegerField()
+    # Storage name of the partial archive written by the run that
+    # checkpointed the batch
+    archive = models.CharField(max_length=255, blank=True, default='')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'start'],
+                                    name='unique_bulk_job_batch'),
+        ]
+
+
+class BulkJobChunk(models.Model):
+    """
+    Lease on a chunk of bulk job rows, held by the task rendering it.
+
+    Taken when a chunk task starts and renewed after every batch. Chunks
+    still waiting in a queue have no lease, so only a chunk that started
+    and then went silent makes its job stale.
+    """
+    job = models.ForeignKey(
+        BulkQRJob, on_delete=models.CASCADE, related_name='chunks')
+    # First CSV record of the chunk
+    start = models.PositiveIntegerField()
+    task_id = models.CharField(max_length=255)
+    heartbeat_at = models.DateTimeField()
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'start'],
+                                    name='unique_bulk_job_chunk'),
+        ]
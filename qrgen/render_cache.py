@@ -0,0 +1,216 @@
+"""
+Content-addressed cache of encoded QR code images.
+
+An image is fully determined by its payload, colors, error correction,
+size, logo and output format, so those inputs are hashed into the cache key
+and the encoded PNG/SVG/PDF bytes are stored under it. Entries live in a
+byte-bounded in-memory LRU in front of an on-disk store shared by all
+processes on the host. The disk store evicts its oldest files once it grows
+past its size limit.
+
+Entries are grouped by owner (a QR code pk, or 'preview') so everything
+rendered for one code can be purged when it changes.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Bump when the renderers change output so stale entries are not served
+RENDER_VERSION = 5
+
+
+def render_key(fmt, data, fill_color, back_color, error_correction, size,
+               logo_name=None):
+    """Hash the inputs that determine a rendered image"""
+    parts = [str(RENDER_VERSION), fmt, data, fill_color.lower(), back_color.lower(),
+             error_correction, str(size), logo_name or '']
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+
+class RenderCache:
+    """Two-tier (memory, disk) store of encoded images"""
+
+    def __init__(self, memory_bytes, directory, disk_bytes,
+                 stats_interval=0):
+        self.memory_bytes = memory_bytes
+        self.directory = Path(directory) if directory else None
+        self.disk_bytes = disk_bytes
+        self.stats_interval = stats_interval
+        self._stats_logged = time.monotonic()
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk_size = None
+        self._lock = threading.Lock()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+    def _path(self, owner, key):
+        return self.directory / owner / key
+
+    def _remember(self, owner, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop((owner, key), None)
+            if old is not None:
+                self._memory_size -= len(old)
+            self._memory[(owner, key)] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def get(self, owner, key):
+        data = self._lookup(owner, key)
+        self._log_stats()
+        return data
+
+    def _lookup(self, owner, key):
+        with self._lock:
+            data = self._memory.get((owner, key))
+            if data is not None:
+                self._memory.move_to_end((owner, key))
+                self.hits_memory += 1
+                return data
+
+        if self.directory is not None:
+            path = self._path(owner, key)
+            try:
+                data = path.read_bytes()
+            except OSError:
+                pass
+            else:
+                # Refresh the mtime so eviction sees this entry as recent
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                self.hits_disk += 1
+                self._remember(owner, key, data)
+                return data
+
+        self.misses += 1
+        return None
+
+    def set(self, owner, key, data):
+        self._remember(owner, key, data)
+        if self.directory is None:
+            return
+        path = self._path(owner, key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a temp file and rename so readers never see a partial
+            fd, tmp = tempfile.mkstemp(dir=path.parent)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            logger.warning('Could not write render cache entry %s', path,
+                           exc_info=True)
+            return
+        self._account(len(data))
+
+    def get_or_render(self, owner, key, render):
+        """Return cached bytes, or call ``render()`` and cache its result"""
+        data = self.get(owner, key)
+        if data is None:
+            data = render()
+            self.set(owner, key, data)
+        return data
+
+    def purge(self, owner):
+        """Drop every entry rendered for one owner"""
+        owner = str(owner)
+        with self._lock:
+            for entry in [k for k in self._memory if k[0] == owner]:
+                self._memory_size -= len(self._memory.pop(entry))
+        if self.directory is not None:
+            directory = self.directory / owner
+            try:
+                removed = sum(entry.stat().st_size
+                              for entry in os.scandir(directory))
+            except OSError:
+                removed = 0
+            shutil.rmtree(directory, ignore_errors=True)
+            with self._lock:
+                if self._disk_size is not None:
+                    self._disk_size -= removed
+
+    def disk_entries(self):
+        """Yield (mtime, size, path) for every file in the disk store"""
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _account(self, added):
+        with self._lock:
+            if self._disk_size is None:
+                self._disk_size = sum(
+                    size for _, size, _ in self.disk_entries())
+            else:
+                self._disk_size += added
+            if self._disk_size <= self.disk_bytes:
+                return
+        self.evict()
+
+    def evict(self):
+        """Delete the oldest files until the disk store is under 90% of its limit"""
+        files = sorted(self.disk_entries())
+        total = sum(size for _, size, _ in files)
+        target = self.disk_bytes * 0.9
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        with self._lock:
+            self._disk_size = total
+
+    def _log_stats(self):
+        """Log the counters every stats_interval seconds; they are kept
+        per process, so each process logs its own"""
+        if not self.stats_interval:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._stats_logged < self.stats_interval:
+                return
+            self._stats_logged = now
+        logger.info('Render cache (pid %s): %s', os.getpid(), self.stats())
+
+    def stats(self):
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        return {
+            'hits_memory': self.hits_memory,
+            'hits_disk': self.hits_disk,
+            'misses': self.misses,
+            'hit_rate': (lookups - self.misses) / lookups if lookups else 0.0,
+            'memory_entries': len(self._memory),
+            'memory_bytes': self._memory_size,
+        }
+
+
+render_cache = RenderCache(settings.RENDER_CACHE_MEMORY_BYTES,
+                           settings.RENDER_CACHE_DIR,
+                           settings.RENDER_CACHE_DISK_BYTES,
+                           settings.RENDER_CACHE_STATS_INTERVAL)
@@ -0,0 +1,240 @@
+"""
+Short URL allocation for dynamic QR codes.
+
+Codes come from a counter row in the database. Each process reserves a block
+of consecutive numbers with a single UPDATE and hands them out from memory,
+so creating a code does not need an ``exists()`` probe and two processes can
+never issue the same code.
+
+Numbers are turned into fixed-width base62 strings. When the counter has a
+key, the number is first passed through a keyed Feistel permutation so that
+consecutive codes look unrelated and cannot be guessed from each other. The
+permutation is a bijection on the code space, so uniqueness is preserved.
+
+Allocated codes are 7 characters long, which keeps them disjoint from the
+8-character random codes issued before the allocator existed.
+"""
+import hashlib
+import os
+import secrets
+import string
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+
+ALPHABET = string.digits + string.ascii_letters
+CODE_LENGTH = 7
+CODE_SPACE = len(ALPHABET) ** CODE_LENGTH
+
+# Feistel network over 42-bit values; results >= CODE_SPACE are re-encrypted
+# (cycle walking) until they land inside the code space
+HALF_BITS = 21
+HALF_MASK = (1 << HALF_BITS) - 1
+ROUNDS = 4
+
+COUNTER_NAME = 'short_url'
+
+
+def _round(value, key, index):
+    digest = hashlib.blake2b(value.to_bytes(3, 'big') + bytes([index]),
+                             key=key, digest_size=3).digest()
+    return int.from_bytes(digest, 'big') & HALF_MASK
+
+
+def _feistel(value, key):
+    left, right = value >> HALF_BITS, value & HALF_MASK
+    for index in range(ROUNDS):
+        left, right = right, left ^ _round(right, key, index)
+    return (left << HALF_BITS) | right
+
+
+def _feistel_inverse(value, key):
+    left, right = value >> HALF_BITS, value & HALF_MASK
+    for index in reversed(range(ROUNDS)):
+        left, right = right ^ _round(left, key, index), left
+    return (left << HALF_BITS) | right
+
+
+def scramble(number, key):
+    """Map a number in [0, CODE_SPACE) to another one, bijectively"""
+    if not key:
+        return number
+    value = _feistel(number, key)
+    while value >= CODE_SPACE:
+        value = _feistel(value, key)
+    return value
+
+
+def unscramble(number, key):
+    """Inverse of scramble"""
+    if not key:
+        return number
+    value = _feistel_inverse(number, key)
+    while value >= CODE_SPACE:
+        value = _feistel_inverse(value, key)
+    return value
+
+
+def to_base62(number):
+    """Encode a number as a fixed-width base62 string"""
+    chars = []
+    for _ in range(CODE_LENGTH):
+        number, remainder = divmod(number, len(ALPHABET))
+        chars.append(ALPHABET[remainder])
+    return ''.join(reversed(chars))
+
+
+def encode(number, key):
+    """Turn a counter value into a short URL code"""
+    if not 0 <= number < CODE_SPACE:
+        raise ValueError('Short URL code space exhausted')
+    return to_base62(scramble(number, key))
+
+
+def decode(code, key):
+    """
+    Turn an allocated short URL code back into its counter value.
+
+    Returns None if the code is not a well-formed allocated code.
+    """
+    if len(code) != CODE_LENGTH:
+        return None
+    number = 0
+    for char in code:
+        digit = ALPHABET.find(char)
+        if digit < 0:
+            return None
+        number = number * len(ALPHABET) + digit
+    return unscramble(number, key)
+
+
+def reserve_block(size):
+    """
+    Reserve ``size`` consecutive counter values.
+
+    Returns (start, key). Takes one UPDATE and one SELECT inside a
+    transaction, regardless of the block size.
+    """
+    from .models import ShortCodeCounter
+
+    with transaction.atomic():
+        updated = ShortCodeCounter.objects.filter(name=COUNTER_NAME).update(
+            next_value=F('next_value') + size)
+        if not updated:
+            key = secrets.token_hex(16) if settings.SHORT_URL_SCRAMBLE else ''
+            ShortCodeCounter.objects.get_or_create(
+                name=COUNTER_NAME, defaults={'next_value': 0, 'key': key})
+            ShortCodeCounter.objects.filter(name=COUNTER_NAME).update(
+                next_value=F('next_value') + size)
+        counter = ShortCodeCounter.objects.get(name=COUNTER_NAME)
+    return counter.next_value - size, bytes.fromhex(counter.key)
+
+
+class ShortCodeAllocator:
+    """
+    Hands out codes from a block reserved for this process.
+
+    A block is abandoned once it is ``block_ttl`` seconds old, so any code
+    below a counter value read more than ``block_ttl`` seconds ago has
+    already been handed out (qrgen.cache relies on this, and on codes being
+    saved soon after; see reserved_short_urls for codes that are not).
+    """
+
+    def __init__(self, block_size, block_ttl):
+        self.block_size = block_size
+        self.block_ttl = block_ttl
+        self._next = 0
+        self._end = 0
+        self._expires = 0
+        self._key = b''
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        """Return one unused short URL code"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # A forked child must not reuse its parent's block
+                self._next = self._end = 0
+                self._pid = os.getpid()
+            if self._next >= self._end or time.monotonic() > self._expires:
+                self._next, self._key = reserve_block(self.block_size)
+                self._end = self._next + self.block_size
+                self._expires = time.monotonic() + self.block_ttl
+            number = self._next
+            self._next += 1
+            key = self._key
+        return encode(number, key)
+
+    def allocate_many(self, count):
+        """Return ``count`` unused codes using a single dedicated block"""
+        if count <= 0:
+            return []
+        start, key = reserve_block(count)
+        return [encode(number, key) for number in range(start, start + count)]
+
+
+allocator = ShortCodeAllocator(settings.SHORT_URL_BLOCK_SIZE,
+                               settings.SHORT_URL_BLOCK_TTL)
+
+
+def allocate_short_url():
+    """Return a new unique short URL code"""
+    return allocator.allocate()
+
+
+def allocate_short_urls(count):
+    """Return ``count`` new unique short URL codes"""
+    return allocator.allocate_many(count)
+
+
+def allocate_unused_short_urls(count):
+    """
+    Return ``count`` new codes, checked against existing codes at once.
+
+    Allocated codes never collide with each other; the single ``IN`` query
+    guards against codes issued from elsewhere (an imported row, a counter
+    restored from an old backup).
+    """
+    from .models import QRCode
+
+    codes = []
+    while len(codes) < count:
+        batch = allocate_short_urls(count - len(codes))
+        taken = set(QRCode.objects.filter(short_url__in=batch).values_list(
+            'short_url', flat=True))
+        codes += [code for code in batch if code not in taken]
+    return codes
+
+
+@contextmanager
+def reserved_short_urls(count):
+    """
+    Allocate ``count`` unused codes for rows that are saved later than usual.
+
+    The counter value below the codes is recorded as a ShortURLReservation
+    until the block exits, so the short URL filter does not trust codes
+    missing from its last build meanwhile. Exit only once the rows using
+    the codes are committed.
+    """
+    from .models import ShortCodeCounter, ShortURLReservation
+
+    if count <= 0:
+        yield []
+        return
+    with transaction.atomic():
+        # Another process may reserve between the read and the allocation;
+        # that only makes the recorded start lower than it needs to be
+        start = ShortCodeCounter.objects.filter(
+            name=COUNTER_NAME).values_list('next_value', flat=True).first()
+        reservation = ShortURLReservation.objects.create(start=start or 0)
+        codes = allocate_unused_short_urls(count)
+    try:
+        yield codes
+    finally:
+        reservation.delete()
@@ -1,81 +1,384 @@
-from celery import shared_task
-from .models import BulkQRJob, QRCode
-from .utils import generate_qr_code
+from celery import chain, chord, shared_task
+from .models import (BulkJobBatch, BulkJobChunk, BulkQRJob, QRCode,
+                     ShortURLReservation)
+from .utils import RenderSpec, render_batch, render_pool
 import csv
+import tempfile
+import time
 import zipfile
-import io
-from PIL import Image
-from django.core.files.base import ContentFile
+from collections import namedtuple
+from datetime import timedelta
+from itertools import islice
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .bulkcsv import validate_bulk_csv
+from .cache import register_short_url
+from .ingest import get_scan_buffer
+from .shortcodes import reserved_short_urls
 
 
-@shared_task
+# One record of a bulk job's normalized CSV; destination_url is set for
+# dynamic codes
+BulkRow = namedtuple('BulkRow', ['row', 'name', 'spec', 'destination_url',
+                                 'filename', 'duplicate_of'])
+
+
+def read_bulk_rows(csv_file, start=0, stop=None):
+    """
+    Yield a BulkRow for each record of a normalized bulk CSV.
+
+    Dynamic codes have no data in their spec until a short URL is
+    allocated. ``row`` is the record's index (header excluded); ``start``
+    and ``stop`` select a range of records. ``filename`` is the row's
+    archive entry, and ``duplicate_of`` the entry of an earlier row with
+    the same image, if any.
+    """
+    records = islice(csv.DictReader(csv_file), start, stop)
+    for row_index, row in enumerate(records, start):
+        destination_url = row['destination_url'] or None
+        spec = RenderSpec(None if destination_url else row['data'],
+                          row['fill_color'], row['back_color'],
+                          row['error_correction'], int(row['size']))
+        yield BulkRow(row_index, row['name'], spec, destination_url,
+                      row['filename'], row['duplicate_of'] or None)
+
+
+def partial_archive_dir(job_id):
+    """Storage directory holding a bulk job's partial archives"""
+    return f'bulk_results/parts/{job_id}'
+
+
+def partial_archive_name(job_id, start):
+    """
+    Storage name for the ZIP built by the batch starting at row start.
+
+    Storage picks another name if the file exists (a concurrent or crashed
+    run of the batch), so the name actually saved is kept on the batch's
+    checkpoint.
+    """
+    return f'{partial_archive_dir(job_id)}/{start:09d}.zip'
+
+
+def acquire_chunk_lease(job, start, task_id):
+    """
+    Take the lease on a job's chunk for a task. Returns False while a
+    different task holds a live lease on the chunk.
+    """
+    now = timezone.now()
+    lease, created = BulkJobChunk.objects.get_or_create(
+        job=job, start=start,
+        defaults={'task_id': task_id, 'heartbeat_at': now})
+    if created:
+        return True
+    # A redelivered task keeps its id; finished and stale leases are free
+    cutoff = now - timedelta(seconds=settings.BULK_STALE_AFTER)
+    return BulkJobChunk.objects.filter(
+        Q(task_id=task_id) | Q(finished_at__isnull=False)
+        | Q(heartbeat_at__lt=cutoff),
+        pk=lease.pk,
+    ).update(task_id=task_id, heartbeat_at=now, finished_at=None) == 1
+
+
+def fail_bulk_job(job, error):
+    job.status = 'failed'
+    job.error_message = str(error)
+    job.save(update_fields=['status', 'error_message'])
+
+
+# Bulk tasks are acknowledged only once they finish, so a task whose
+# worker dies is delivered again; checkpoints make the rerun cheap
+bulk_task = shared_task(acks_late=True, reject_on_worker_lost=True)
+
+
+@bulk_task
 def process_bulk_qr_code(job_id):
-    """Process bulk QR code generation from CSV"""
+    """
+    Process bulk QR code generation from CSV.
+
+    The upload is first validated into a normalized CSV of its valid rows
+    (see qrgen.bulkcsv), which is split into chunks of BULK_CHUNK_SIZE
+    rows. Chunks are dealt round-robin into BULK_CONCURRENCY lanes; each
+    lane is a chain of chunk tasks, and the lanes run as a chord whose
+    callback merges the partial archives. Running it again for an
+    unfinished job (a retry, or a stale job being reclaimed) resumes from
+    the job's checkpoints; chunks another run is rendering are skipped.
+    """
     job = BulkQRJob.objects.get(id=job_id)
+    if job.status == 'completed':
+        return
     job.status = 'processing'
-    job.save()
+    job.error_message = None
+    job.save(update_fields=['status', 'error_message'])
 
     try:
-        # Read CSV file
-        csv_file = job.file.open('r')
-        reader = csv.DictReader(csv_file)
-
-        # Create ZIP file
-        zip_buffer = io.BytesIO()
-        zip_file = zipfile.ZipFile(zip_buffer, 'w')
-
-        qr_codes_created = []
-
-        for row in reader:
-            # Extract data from CSV
-            name = row.get('name', 'QR Code')
-            data = row.get('data', '')
-            fill_color = row.get('fill_color', '#000000')
-            back_color = row.get('back_color', '#FFFFFF')
-            error_correction = row.get('error_correction', 'M')
-            size = int(row.get('size', 300))
-
-            if data:
-                # Generate QR code
-                qr_img = generate_qr_code(
-                    data,
-                    fill_color,
-                    back_color,
-                    error_correction,
-                    size
-                )
-
-                # Convert to PNG
-                img_buffer = io.BytesIO()
-                qr_img.save(img_buffer, format='PNG')
-                img_buffer.seek(0)
-
-                # Add to ZIP
-                zip_file.writestr(f'{name}.png', img_buffer.getvalue())
-
-                # Create QR code record
-                qr_code = QRCode.objects.create(
-                    user=job.user,
-                    name=name,
-                    data=data,
-                    qr_type='static',
-                    fill_color=fill_color,
-                    back_color=back_color,
-                    error_correction=error_correction,
-                    size=size,
-                )
-                qr_codes_created.append(qr_code)
-
-        zip_file.close()
-
-        # Save ZIP file
-        zip_buffer.seek(0)
-        job.result = ContentFile(zip_buffer.getvalue(), name='qr_codes.zip')
-        job.status = 'completed'
-        job.save()
+        if not job.normalized_file:
+            # Validate every row before rendering any; a resumed job keeps
+            # its normalized CSV so row indexes match its checkpoints
+            job.rows_total, job.rows_failed = validate_bulk_csv(job)
+            job.save(update_fields=['normalized_file', 'error_report',
+                                    'rows_total', 'rows_failed'])
+        with job.normalized_file.open('r') as csv_file:
+            rows = sum(1 for _ in csv.DictReader(csv_file))
+    except Exception as e:
+        fail_bulk_job(job, e)
+        raise
+
+    chunk_size = settings.BULK_CHUNK_SIZE
+    chunks = -(-rows // chunk_size)
+    finalize = finalize_bulk_job.si(job_id)
+    if not chunks:
+        finalize.delay()
+        return
+
+    lanes = [[] for _ in range(min(settings.BULK_CONCURRENCY, chunks))]
+    for index in range(chunks):
+        start = index * chunk_size
+        lanes[index % len(lanes)].append(
+            process_bulk_chunk.si(job_id, start, start + chunk_size))
+    chord([chain(*lane) for lane in lanes])(finalize)
+
+
+def write_bulk_batch(job, batch, persisted=False, pool=None):
+    """
+    Render and persist one batch of BulkRows.
+
+    Dynamic rows get short URLs allocated for the whole batch at once, and
+    reserved until the batch is committed: rendering may outlast the time
+    the short URL filter allows between allocating a code and saving it.
+    Codes are encoded here, once, for their stored matrix; the workers of
+    ``pool`` (see render_pool) reuse it. A row whose image duplicates an
+    earlier row's is not rendered: its entry is an empty alias whose
+    comment names the entry holding the image, which finalize_bulk_job
+    fills in.
+
+    The batch's PNGs are stored as a partial archive, then its rows, its
+    checkpoint and the job's progress are written in one transaction.
+    With ``persisted`` (the checkpoint exists but its archive was lost)
+    only the archive is rebuilt, from the saved short URLs.
+    """
+    start, stop = batch[0].row, batch[-1].row + 1
+    dynamic_rows = [row.row for row in batch if row.destination_url]
+    new_codes = 0 if persisted else len(dynamic_rows)
+    with reserved_short_urls(new_codes) as reserved:
+        if persisted:
+            short_urls = dict(QRCode.objects.filter(
+                bulk_job=job, bulk_row__in=dynamic_rows,
+            ).values_list('bulk_row', 'short_url'))
+        else:
+            short_urls = dict(zip(dynamic_rows, reserved))
+
+        entries, specs = [], []
+        failed = 0
+        for row, name, spec, destination_url, filename, duplicate_of in batch:
+            if destination_url and row not in short_urls:
+                failed += 1
+                continue
+            qr_code = QRCode(
+                user=job.user,
+                name=name,
+                data=spec.data,
+                qr_type='dynamic' if destination_url else 'static',
+                destination_url=destination_url,
+                short_url=short_urls.get(row),
+                fill_color=spec.fill_color,
+                back_color=spec.back_color,
+                error_correction=spec.error_correction,
+                size=spec.size,
+                bulk_job=job,
+                bulk_row=row,
+            )
+            qr_code.update_matrix()
+            if qr_code.matrix is None:
+                # Too much data to encode
+                failed += 1
+                continue
+            entries.append((qr_code, filename, duplicate_of))
+            if not duplicate_of:
+                payload = qr_code.get_data_url()
+                specs.append(spec._replace(
+                    data=payload, modules=qr_code.stored_modules(payload)))
+        codes = [qr_code for qr_code, filename, duplicate_of in entries]
+
+        # Generate the PNGs across the render pool, in CSV order, into an
+        # archive spooled to disk
+        with tempfile.TemporaryFile() as archive:
+            with zipfile.ZipFile(archive, 'w') as zip_file:
+                pngs = render_batch(specs, pool)
+                for qr_code, filename, duplicate_of in entries:
+                    if duplicate_of:
+                        alias = zipfile.ZipInfo(filename, time.localtime()[:6])
+                        alias.comment = duplicate_of.encode()
+                        zip_file.writestr(alias, b'')
+                    else:
+                        zip_file.writestr(filename, next(pngs))
+            archive.seek(0)
+            name = default_storage.save(partial_archive_name(job.pk, start),
+                                        File(archive))
+
+        if persisted:
+            BulkJobBatch.objects.filter(job=job, start=start).update(
+                archive=name)
+            return
+        try:
+            with transaction.atomic():
+                BulkJobBatch.objects.create(job=job, start=start, stop=stop,
+                                            archive=name)
+                QRCode.objects.bulk_create(codes, ignore_conflicts=True)
+                BulkQRJob.objects.filter(pk=job.pk).update(
+                    rows_processed=F('rows_processed') + len(codes),
+                    rows_failed=F('rows_failed') + failed)
+        except IntegrityError:
+            # Another run of this chunk checkpointed the batch first, with
+            # its own archive
+            default_storage.delete(name)
+            return
+    for qr_code in codes:
+        register_short_url(qr_code.short_url)
+
+
+@bulk_task
+def process_bulk_chunk(job_id, start, stop):
+    """
+    Render and persist rows [start, stop) of a bulk job.
+
+    Runs under the chunk's lease, renewed after every batch. If another
+    run holds the lease, or takes it over, this one stops and leaves the
+    chunk to it. The chunk's batches share one render pool.
+    """
+    job = BulkQRJob.objects.get(id=job_id)
+    if job.status != 'processing':
+        # Another chunk failed, or a duplicate run already finished the job
+        return
+    task_id = process_bulk_chunk.request.id
+    if not acquire_chunk_lease(job, start, task_id):
+        return
+    lease = BulkJobChunk.objects.filter(job=job, start=start, task_id=task_id)
+    checkpoints = dict(job.batches.filter(
+        start__gte=start, start__lt=stop).values_list('start', 'archive'))
+
+    try:
+        # The CSV is read as a stream, so only one batch of rows is held
+        # in memory at a time
+        with render_pool() as pool, \
+                job.normalized_file.open('r') as csv_file:
+            rows = read_bulk_rows(csv_file, start, stop)
+            while batch := list(islice(rows, settings.BULK_BATCH_SIZE)):
+                persisted = batch[0].row in checkpoints
+                archive = checkpoints.get(batch[0].row)
+                if archive and default_storage.exists(archive):
+                    continue
+                write_bulk_batch(job, batch, persisted, pool)
+                if not lease.update(heartbeat_at=timezone.now()):
+                    # Reclaimed by another run
+                    return
 
     except Exception as e:
-        job.status = 'failed'
-        job.error_message = str(e)
-        job.save()
+        lease.delete()
+        fail_bulk_job(job, e)
         raise
+    lease.update(finished_at=timezone.now())
+
+
+@bulk_task
+def finalize_bulk_job(job_id):
+    """
+    Merge a bulk job's partial archives, in row order, into its result.
+
+    Alias entries get the bytes of the image they name. Only images some
+    alias names are kept in memory, and each is kept once. Does nothing
+    while a chunk is still being rendered by another run of the job,
+    whose own chord finalizes it.
+    """
+    job = BulkQRJob.objects.get(id=job_id)
+    if job.status != 'processing':
+        return
+    if job.chunks.filter(finished_at__isnull=True).exists():
+        return
+    parts = list(job.batches.order_by('start').values_list(
+        'archive', flat=True))
+
+    try:
+        # Reading the parts' directories is enough to find the images
+        # aliases need
+        aliased = set()
+        for part in parts:
+            with default_storage.open(part, 'rb') as f, \
+                    zipfile.ZipFile(f) as part_zip:
+                aliased.update(info.comment.decode()
+                               for info in part_zip.infolist() if info.comment)
+
+        images = {}
+        with tempfile.TemporaryFile() as archive:
+            with zipfile.ZipFile(archive, 'w') as zip_file:
+                for part in parts:
+                    with default_storage.open(part, 'rb') as f, \
+                            zipfile.ZipFile(f) as part_zip:
+                        for info in part_zip.infolist():
+                            if info.comment:
+                                zip_file.writestr(
+                                    zipfile.ZipInfo(info.filename,
+                                                    info.date_time),
+                                    images[info.comment.decode()])
+                                continue
+                            png = part_zip.read(info)
+                            zip_file.writestr(info, png)
+                            if info.filename in aliased:
+                                images[info.filename] = png
+
+            # Save ZIP file; storage copies it over in chunks
+            archive.seek(0)
+            job.result.save('qr_codes.zip', File(archive), save=False)
+    except Exception as e:
+        fail_bulk_job(job, e)
+        raise
+
+    job.status = 'completed'
+    job.completed_at = timezone.now()
+    job.save(update_fields=['result', 'status', 'completed_at'])
+    # Also removes archives of runs that never checkpointed their batch
+    directory = partial_archive_dir(job_id)
+    try:
+        parts = [f'{directory}/{name}'
+                 for name in default_storage.listdir(directory)[1]]
+    except FileNotFoundError:
+        pass
+    for part in parts:
+        default_storage.delete(part)
+    job.batches.all().delete()
+    job.chunks.all().delete()
+
+
+@shared_task(ignore_result=True)
+def reclaim_stale_bulk_jobs():
+    """
+    Re-dispatch processing jobs with a chunk that started and went silent.
+
+    Chunks waiting in a busy queue hold no lease and do not count. A chunk
+    whose worker died is normally redelivered first (acks_late), keeping
+    its task id and so its lease. Short URL reservations that old belong
+    to batches whose worker died; they are dropped.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.BULK_STALE_AFTER)
+    ShortURLReservation.objects.filter(created_at__lt=cutoff).delete()
+    stale = BulkJobChunk.objects.filter(
+        job__status='processing', finished_at__isnull=True,
+        heartbeat_at__lt=cutoff)
+    reclaimed = 0
+    for job_id in set(stale.values_list('job_id', flat=True)):
+        # Releasing the stale leases claims the job, so overlapping runs
+        # dispatch it once
+        released, _ = stale.filter(job_id=job_id).delete()
+        if released:
+            process_bulk_qr_code.delay(job_id)
+            reclaimed += 1
+    return reclaimed
+
+
+@shared_task(ignore_result=True)
+def flush_scan_buffer():
+    """Drain buffered scans into the database in batches"""
+    return get_scan_buffer().flush()
@@ -0,0 +1,459 @@
+import ipaddress
+import os
+import random
+import string
+import struct
+import tempfile
+import tracemalloc
+import zipfile
+from datetime import timedelta
+from unittest import mock
+
+import numpy as np
+import qrcode
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from . import encoder, geoip, shortcodes, tasks
+from .cache import ShortURLFilter
+from .models import BulkJobChunk, BulkQRJob, User
+
+
+class EncoderTests(SimpleTestCase):
+    """The NumPy encoder against qrcode, module for module"""
+
+    LEVELS = [qrcode.constants.ERROR_CORRECT_L,
+              qrcode.constants.ERROR_CORRECT_M,
+              qrcode.constants.ERROR_CORRECT_Q,
+              qrcode.constants.ERROR_CORRECT_H]
+    LENGTHS = [1, 7, 20, 45, 120, 300, 700]
+
+    def corpus(self):
+        """Numeric, alphanumeric, byte and multi-byte payloads, short URLs"""
+        rng = random.Random(14)
+        alnum = string.ascii_uppercase + string.digits + ' $%*+-./:'
+        for length in self.LENGTHS:
+            yield ''.join(rng.choice(string.digits) for _ in range(length))
+            yield ''.join(rng.choice(alnum) for _ in range(length))
+            yield ''.join(rng.choice(string.printable) for _ in range(length))
+            yield ''.join(chr(rng.randrange(0x400, 0x4ff))
+                          for _ in range(length // 2 + 1))
+            yield 'https://example.com/' + ''.join(
+                rng.choice(string.ascii_letters) for _ in range(length))
+        for _ in range(20):
+            code = ''.join(rng.choice(string.ascii_letters + string.digits)
+                           for _ in range(7))
+            yield f'https://qr.example.com/redirect/{code}/'
+
+    def reference(self, data, error_correction):
+        qr = qrcode.QRCode(error_correction=error_correction, border=0)
+        qr.add_data(data)
+        qr.make(fit=True)
+        modules = qr.modules
+        # make() does not keep the mask it picked
+        mask = qr.best_mask_pattern()
+        qr.makeImpl(False, mask)
+        self.assertEqual(qr.modules, modules)
+        return np.array(modules, dtype=np.uint8), qr.version, mask
+
+    def test_matches_reference(self):
+        for data in self.corpus():
+            for error_correction in self.LEVELS:
+                with self.subTest(data=data[:30], length=len(data),
+                                  error_correction=error_correction):
+                    try:
+                        expected = self.reference(data, error_correction)
+                    except (qrcode.exceptions.DataOverflowError, ValueError):
+                        with self.assertRaises(
+                                qrcode.exceptions.DataOverflowError):
+                            encoder.encode(data, error_correction)
+                        continue
+                    modules, version, mask = encoder.encode(
+                        data, error_correction)
+                    self.assertEqual((version, mask), expected[1:])
+                    np.testing.assert_array_equal(modules, expected[0])
+
+    def test_overflow_raises_data_overflow_error(self):
+        # The one known difference: past version 40 the reference raises a
+        # plain ValueError, the encoder DataOverflowError
+        rng = random.Random(1)
+        for length, error_correction in [
+                (1500, qrcode.constants.ERROR_CORRECT_H),
+                (1700, qrcode.constants.ERROR_CORRECT_Q)]:
+            data = ''.join(rng.choice(string.printable)
+                           for _ in range(length))
+            with self.subTest(length=length):
+                with self.assertRaises(ValueError) as raised:
+                    self.reference(data, error_correction)
+                self.assertNotIsInstance(
+                    raised.exception, qrcode.exceptions.DataOverflowError)
+                with self.assertRaises(qrcode.exceptions.DataOverflowError):
+                    encoder.encode(data, error_correction)
+
+
+# MaxMind DB data types
+UINT16, UINT64 = 5, 9
+
+
+class MMDBWriter:
+    """
+    Minimal MaxMind DB writer for test fixtures: an IPv6 search tree with
+    24-bit records, IPv4 networks stored under ::/96, and maps, strings
+    and unsigned integers in the data section. A (type, int) tuple is
+    written as that integer type, as the metadata requires.
+    """
+
+    def __init__(self):
+        self.root = [None, None]
+
+    def insert(self, network, record):
+        """Insert a network; insert larger networks before their subnets"""
+        network = ipaddress.ip_network(network)
+        bits = int(network.network_address)
+        depth = network.prefixlen + (96 if network.version == 4 else 0)
+        node = self.root
+        for i in range(depth - 1):
+            bit = bits >> (127 - i) & 1
+            if not isinstance(node[bit], list):
+                # Split a leaf: both halves keep its record
+                node[bit] = [node[bit], node[bit]]
+            node = node[bit]
+        node[bits >> (128 - depth) & 1] = record
+
+    @staticmethod
+    def _control(type_, size):
+        extended = type_ > 7
+        first = (0 if extended else type_) << 5
+        if size < 29:
+            head, tail = bytes([first | size]), b''
+        elif size < 285:
+            head, tail = bytes([first | 29]), bytes([size - 29])
+        else:
+            head, tail = bytes([first | 30]), struct.pack('>H', size - 285)
+        return head + (bytes([type_ - 7]) if extended else b'') + tail
+
+    def _encode(self, value):
+        if isinstance(value, dict):
+            return self._control(7, len(value)) + b''.join(
+                self._encode(key) + self._encode(item)
+                for key, item in value.items())
+        if isinstance(value, list):
+            return self._control(11, len(value)) + b''.join(
+                self._encode(item) for item in value)
+        if isinstance(value, str):
+            data = value.encode()
+            return self._control(2, len(data)) + data
+        type_, value = value if isinstance(value, tuple) else (6, value)
+        data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+        return self._control(type_, len(data)) + data
+
+    def write(self, path):
+        nodes = [self.root]
+        for node in nodes:
+            nodes.extend(child for child in node if isinstance(child, list))
+        numbers = {id(node): number for number, node in enumerate(nodes)}
+
+        data, offsets = b'', {}
+
+        def record_value(child):
+            nonlocal data
+            if isinstance(child, list):
+                return numbers[id(child)]
+            if child is None:
+                return len(nodes)
+            if id(child) not in offsets:
+                offsets[id(child)] = len(data)
+                data += self._encode(child)
+            return len(nodes) + 16 + offsets[id(child)]
+
+        tree = b''.join(
+            record_value(left).to_bytes(3, 'big')
+            + record_value(right).to_bytes(3, 'big')
+            for left, right in nodes)
+        metadata = self._encode({
+            'node_count': len(nodes),
+            'record_size': (UINT16, 24),
+            'ip_version': (UINT16, 6),
+            'database_type': 'Test-City',
+            'languages': ['en'],
+            'binary_format_major_version': (UINT16, 2),
+            'binary_format_minor_version': (UINT16, 0),
+            'build_epoch': (UINT64, 1700000000),
+            'description': {'en': 'Test fixture'},
+        })
+        with open(path, 'wb') as f:
+            f.write(tree + bytes(16) + data + b'\xab\xcd\xefMaxMind.com'
+                    + metadata)
+
+
+def city(country, name):
+    return {'country': {'names': {'en': country}},
+            'city': {'names': {'en': name}}}
+
+
+class GeoIPTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.database = os.path.join(cls.directory.name, 'test.mmdb')
+        writer = MMDBWriter()
+        writer.insert('198.51.100.0/24', city('Exampleland', 'Sampleton'))
+        # A /24 the database splits into two networks
+        writer.insert('203.0.113.0/25', city('Exampleland', 'Lowtown'))
+        writer.insert('203.0.113.128/25', city('Exampleland', 'Highville'))
+        writer.insert('2001:db8:1::/48', city('Sixland', 'Hexham'))
+        writer.write(cls.database)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        # Reopen the database with each test's settings
+        geoip._reader_pid = None
+        geoip._cache.clear()
+        self.addCleanup(geoip._cache.clear)
+        self.addCleanup(setattr, geoip, '_reader_pid', None)
+
+    def no_reader(self):
+        """Fail any lookup that is not served from the cache"""
+        return mock.patch.object(geoip, 'get_reader',
+                                 side_effect=AssertionError('not cached'))
+
+    def test_ipv4_cached_per_24(self):
+        with override_settings(GEOIP_DATABASE=self.database):
+            self.assertEqual(geoip.lookup('198.51.100.7'),
+                             ('Exampleland', 'Sampleton'))
+            with self.no_reader():
+                self.assertEqual(geoip.lookup('198.51.100.250'),
+                                 ('Exampleland', 'Sampleton'))
+
+    def test_split_24_cached_per_address(self):
+        with override_settings(GEOIP_DATABASE=self.database):
+            self.assertEqual(geoip.lookup('203.0.113.5').city, 'Lowtown')
+            self.assertEqual(geoip.lookup('203.0.113.200').city, 'Highville')
+            with self.no_reader():
+                self.assertEqual(geoip.lookup('203.0.113.5').city, 'Lowtown')
+            self.assertEqual(geoip.lookup('203.0.113.6').city, 'Lowtown')
+
+    def test_ipv6_cached_per_48(self):
+        with override_settings(GEOIP_DATABASE=self.database):
+            self.assertEqual(geoip.lookup('2001:db8:1::1'),
+                             ('Sixland', 'Hexham'))
+            with self.no_reader():
+                self.assertEqual(geoip.lookup('2001:db8:1:ffff::2'),
+                                 ('Sixland', 'Hexham'))
+            self.assertEqual(geoip.lookup('2001:db8:2::1'), geoip.UNKNOWN)
+
+    def test_unknown_and_invalid_addresses(self):
+        with override_settings(GEOIP_DATABASE=self.database):
+            self.assertEqual(geoip.lookup('192.0.2.1'), geoip.UNKNOWN)
+            self.assertEqual(geoip.lookup(''), geoip.UNKNOWN)
+            self.assertEqual(geoip.lookup('not an address'), geoip.UNKNOWN)
+
+    def test_missing_database(self):
+        missing = os.path.join(self.directory.name, 'missing.mmdb')
+        with override_settings(GEOIP_DATABASE=missing):
+            self.assertIsNone(geoip.get_reader())
+            self.assertEqual(geoip.lookup('198.51.100.7'), geoip.UNKNOWN)
+
+
+# Celery reads its CELERY_* settings from Django on every access
+@override_settings(SHORT_URL_BLOCK_TTL=0)
+class ShortURLFilterTests(TestCase):
+    def test_reserved_codes_not_trusted_absent(self):
+        url_filter = ShortURLFilter()
+        with shortcodes.reserved_short_urls(3) as codes:
+            # The second build trusts the counter value the first one read,
+            # which is past the reserved codes
+            url_filter.rebuild()
+            url_filter.rebuild()
+            self.assertEqual([url_filter.check(code) for code in codes],
+                             [True] * 3)
+        # Released unsaved: trusted absent again
+        url_filter.rebuild()
+        self.assertEqual([url_filter.check(code) for code in codes],
+                         [False] * 3)
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True,
+                   CELERY_TASK_EAGER_PROPAGATES=True, BULK_CHUNK_SIZE=20,
+                   BULK_BATCH_SIZE=10, BULK_CONCURRENCY=2,
+                   QR_RENDER_PROCESSES=1)
+class BulkJobTests(TestCase):
+    """The bulk pipeline end to end, with Celery tasks run eagerly"""
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.user = User.objects.create(username='bulk')
+
+    def make_job(self, rows):
+        lines = ['name,data'] + [f'code {i},payload {i}' for i in range(rows)]
+        csv_file = ContentFile('\n'.join(lines).encode() + b'\n',
+                               name='bulk.csv')
+        return BulkQRJob.objects.create(user=self.user, file=csv_file)
+
+    def archive_names(self, job):
+        with job.result.open('rb') as f:
+            return zipfile.ZipFile(f).namelist()
+
+    def test_chunks_merged_in_row_order(self):
+        # 3 chunks in 2 lanes: chunk 2 runs before chunk 1
+        job = self.make_job(50)
+        tasks.process_bulk_qr_code(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'completed')
+        self.assertEqual((job.rows_total, job.rows_processed, job.rows_failed),
+                         (50, 50, 0))
+        self.assertEqual(self.archive_names(job),
+                         [f'code {i}.png' for i in range(50)])
+        self.assertEqual(
+            list(job.qr_codes.order_by('bulk_row').values_list('name',
+                                                                flat=True)),
+            [f'code {i}' for i in range(50)])
+        # Checkpoints and leases are dropped once the result is saved
+        self.assertFalse(job.batches.exists())
+        self.assertFalse(job.chunks.exists())
+
+    def test_identical_rows_rendered_once(self):
+        csv_file = ContentFile(b'name,data\n' + b'dup,same\n' * 45,
+                               name='bulk.csv')
+        job = BulkQRJob.objects.create(user=self.user, file=csv_file)
+        with mock.patch.object(tasks, 'render_batch',
+                               wraps=tasks.render_batch) as render:
+            tasks.process_bulk_qr_code(job.id)
+        self.assertEqual(sum(len(call.args[0])
+                             for call in render.call_args_list), 1)
+
+        job.refresh_from_db()
+        self.assertEqual((job.rows_processed, job.rows_failed), (45, 0))
+        self.assertEqual(self.archive_names(job), ['dup.png'] + [
+            f'dup ({i}).png' for i in range(2, 46)])
+        with job.result.open('rb') as f:
+            archive = zipfile.ZipFile(f)
+            images = {archive.read(name) for name in archive.namelist()}
+        self.assertEqual(len(images), 1)
+        self.assertTrue(images.pop().startswith(b'\x89PNG'))
+
+    def test_chunk_failure_fails_job(self):
+        job = self.make_job(50)
+        with mock.patch.object(tasks, 'render_batch',
+                               side_effect=RuntimeError('render failed')), \
+                self.assertRaises(RuntimeError):
+            tasks.process_bulk_qr_code(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.error_message, 'render failed')
+        self.assertFalse(job.result)
+        self.assertFalse(job.chunks.exists())
+
+    def test_retry_resumes_failed_job(self):
+        job = self.make_job(50)
+        render_batch, calls = tasks.render_batch, []
+
+        def fail_third_batch(specs, *args):
+            calls.append(specs)
+            if len(calls) == 3:
+                raise RuntimeError('worker lost')
+            return render_batch(specs, *args)
+
+        with mock.patch.object(tasks, 'render_batch', fail_third_batch), \
+                self.assertRaises(RuntimeError):
+            tasks.process_bulk_qr_code(job.id)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.rows_processed), ('failed', 20))
+
+        # Chunk 0's two checkpointed batches are not rendered again
+        with mock.patch.object(tasks, 'render_batch',
+                               wraps=render_batch) as render:
+            tasks.process_bulk_qr_code(job.id)
+        self.assertEqual(render.call_count, 3)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'completed')
+        self.assertEqual((job.rows_processed, job.rows_failed), (50, 0))
+        self.assertEqual(job.qr_codes.count(), 50)
+        self.assertEqual(self.archive_names(job),
+                         [f'code {i}.png' for i in range(50)])
+
+    def test_stale_lease_taken_over(self):
+        job = self.make_job(50)
+        lease = BulkJobChunk.objects.create(
+            job=job, start=20, task_id='other', heartbeat_at=timezone.now())
+
+        # A live lease: the chunk is left to its holder, which finalizes
+        tasks.process_bulk_qr_code(job.id)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.rows_processed), ('processing', 30))
+        self.assertFalse(job.result)
+
+        # Its holder went silent: a rerun takes the chunk over
+        lease.heartbeat_at -= timedelta(
+            seconds=settings.BULK_STALE_AFTER + 1)
+        lease.save()
+        tasks.process_bulk_qr_code(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'completed')
+        self.assertEqual(job.rows_processed, 50)
+        self.assertEqual(self.archive_names(job),
+                         [f'code {i}.png' for i in range(50)])
+
+    def test_empty_csv_finalized_directly(self):
+        job = self.make_job(0)
+        with mock.patch.object(tasks, 'chord') as chord:
+            tasks.process_bulk_qr_code(job.id)
+        # No chunks: finalize_bulk_job is sent on its own
+        chord.assert_not_called()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'completed')
+        self.assertEqual(job.rows_total, 0)
+        self.assertEqual(self.archive_names(job), [])
+
+    def test_over_capacity_data_reported(self):
+        csv_file = ContentFile(
+            b'name,data,error_correction\n'
+            b'fits,' + b'x' * 1273 + b',H\n'
+            b'too long,' + b'x' * 1274 + b',H\n', name='bulk.csv')
+        job = BulkQRJob.objects.create(user=self.user, file=csv_file)
+        tasks.process_bulk_qr_code(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual((job.rows_total, job.rows_processed, job.rows_failed),
+                         (2, 1, 1))
+        self.assertEqual(self.archive_names(job), ['fits.png'])
+        with job.error_report.open('rb') as f:
+            report = f.read()
+        self.assertEqual(report.split(b'\r\n'), [
+            b'line,column,value,message',
+            b'3,data,' + b'x' * 1274 + b',Too much data for a QR code at '
+            b'this error correction level.',
+            b''])
+
+    def test_memory_flat_in_job_size(self):
+        # A 62.5 MiB archive built within a fraction of that: rows, PNGs
+        # and archive entries are streamed, never collected
+        rows, png = 2000, os.urandom(32 * 1024)
+        job = self.make_job(rows)
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        # A plain function: a Mock would keep every call's specs
+        with mock.patch.object(tasks, 'render_batch',
+                               lambda specs, *args: (png for _ in specs)):
+            tasks.process_bulk_qr_code(job.id)
+        peak = tracemalloc.get_traced_memory()[1]
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'completed')
+        self.assertEqual(job.rows_processed, rows)
+        self.assertGreater(job.result.size, rows * len(png))
+        self.assertLess(peak, 16 * 2**20)
@@ -9,8 +9,10 @@ urlpatterns = [
     path('dashboard/', views.dashboard, name='dashboard'),
     path('create/', views.create_qr, name='create-qr'),
     path('qr/<uuid:pk>/', views.qr_detail, name='qr-detail'),
+    path('qr/<uuid:pk>/image/<str:format>/', views.qr_image, name='qr-image'),
     path('qr/<uuid:pk>/download/<str:format>/',
          views.download_qr, name='download-qr'),
+    path('qr/print-sheet/', views.print_sheet, name='print-sheet'),
     path('qr/<uuid:pk>/analytics/', views.analytics, name='qr-analytics'),
     path('qr/<uuid:pk>/delete/', views.delete_qr, name='delete-qr'),
     path('redirect/<str:short_url>/', views.redirect_qr, name='redirect-qr'),
@@ -20,5 +22,7 @@ urlpatterns = [
 
     # HTMX endpoints
     path('qr/preview/', views.qr_preview, name='qr-preview'),
+    path('qr/preview/<str:token>.png', views.qr_preview_image,
+         name='qr-preview-image'),
     path('qr/<uuid:pk>/update-url/', views.update_dynamic_url, name='update-url'),
 ]
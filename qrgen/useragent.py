@@ -0,0 +1,134 @@
+"""
+User agent classification for scan analytics.
+
+``classify`` scans the user agent once with a single compiled pattern,
+collects the product tokens it finds and then decides device, browser and
+OS from those tokens in priority order. Order matters because most browsers
+claim to be several others: Edge and Samsung Internet also send ``Chrome/``
+and ``Safari/``, and iOS user agents contain ``like Mac OS X``.
+
+Results are memoized per raw user agent string since scan traffic is
+dominated by a small number of distinct agents.
+"""
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+from django.conf import settings
+
+
+UserAgentInfo = namedtuple('UserAgentInfo', [
+    'device_type', 'browser', 'browser_version', 'os', 'os_version'])
+
+UNKNOWN = UserAgentInfo('Desktop', 'Unknown', '', 'Unknown', '')
+
+# Longer user agents are almost always junk; only the prefix is classified
+MAX_LENGTH = 512
+
+# The lookahead lets the scanner skip positions that cannot start a token
+TOKEN_RE = re.compile(
+    r'(?=[ABCEFLMOSTUVWYbcfips])'
+    r'(?P<token>'
+    r'EdgA|EdgiOS|Edge?|OPR|OPiOS|Opera|SamsungBrowser|UCBrowser|YaBrowser|'
+    r'FxiOS|Firefox|CriOS|Chromium|Chrome|Version|Safari|MSIE|Trident|'
+    r'Windows NT|Windows Phone|Android|iPhone OS|CPU OS|iPhone|iPad|iPod|'
+    r'Mac OS X|CrOS|Linux|Mobile|Tablet|'
+    r'[Bb]ot|[Cc]rawler|[Ss]pider|[Ss]lurp|facebookexternalhit|curl|python'
+    r')(?:[/ ]?(?P<version>\d+(?:[._]\d+)*))?'
+)
+
+# Tokens are checked in this order; the first one present wins
+BROWSERS = [
+    (('EdgA', 'EdgiOS', 'Edg', 'Edge'), 'Edge'),
+    (('OPR', 'OPiOS', 'Opera'), 'Opera'),
+    (('SamsungBrowser',), 'Samsung Internet'),
+    (('UCBrowser',), 'UC Browser'),
+    (('YaBrowser',), 'Yandex'),
+    (('FxiOS', 'Firefox'), 'Firefox'),
+    (('CriOS', 'Chrome', 'Chromium'), 'Chrome'),
+    (('MSIE', 'Trident'), 'Internet Explorer'),
+]
+
+OPERATING_SYSTEMS = [
+    (('Windows Phone',), 'Windows Phone'),
+    (('Windows NT',), 'Windows'),
+    (('iPhone OS', 'CPU OS', 'iPhone', 'iPad', 'iPod'), 'iOS'),
+    (('Android',), 'Android'),
+    (('CrOS',), 'ChromeOS'),
+    (('Mac OS X',), 'macOS'),
+    (('Linux',), 'Linux'),
+]
+
+WINDOWS_VERSIONS = {
+    '10.0': '10',
+    '6.3': '8.1',
+    '6.2': '8',
+    '6.1': '7',
+    '6.0': 'Vista',
+    '5.1': 'XP',
+}
+
+BOT_TOKENS = ('bot', 'Bot', 'crawler', 'Crawler', 'spider', 'Spider',
+              'slurp', 'Slurp', 'facebookexternalhit', 'curl', 'python')
+
+
+def _first(tokens, candidates):
+    for candidate in candidates:
+        if candidate in tokens:
+            return candidate
+    return None
+
+
+@lru_cache(maxsize=settings.USER_AGENT_CACHE_SIZE)
+def classify(user_agent):
+    """
+    Classify a user agent string.
+
+    Returns a UserAgentInfo with device type, browser and OS names and versions.
+    """
+    tokens = {}
+    for match in TOKEN_RE.finditer(user_agent[:MAX_LENGTH]):
+        tokens.setdefault(match.group('token'), match.group('version') or '')
+
+    if not tokens:
+        return UNKNOWN
+
+    # Browser
+    browser, browser_version = 'Unknown', ''
+    for candidates, name in BROWSERS:
+        found = _first(tokens, candidates)
+        if found:
+            browser, browser_version = name, tokens[found]
+            break
+    else:
+        if 'Safari' in tokens:
+            browser, browser_version = 'Safari', tokens.get('Version', '')
+    if browser == 'Internet Explorer' and 'MSIE' not in tokens:
+        # IE 11 only sends Trident/7.0
+        browser_version = '11.0'
+
+    # Operating system
+    os_name, os_version = 'Unknown', ''
+    for candidates, name in OPERATING_SYSTEMS:
+        found = _first(tokens, candidates)
+        if found:
+            os_name, os_version = name, tokens[found].replace('_', '.')
+            break
+    if os_name == 'Windows':
+        os_version = WINDOWS_VERSIONS.get(os_version, os_version)
+
+    # Device
+    if _first(tokens, BOT_TOKENS):
+        device_type = 'Bot'
+    elif 'iPad' in tokens or 'Tablet' in tokens or (
+            os_name == 'Android' and 'Mobile' not in tokens):
+        device_type = 'Tablet'
+    elif ('Mobile' in tokens or 'iPhone' in tokens or 'iPod' in tokens
+          or os_name in ('Android', 'Windows Phone')):
+        device_type = 'Mobile'
+    else:
+        device_type = 'Desktop'
+
+    return UserAgentInfo(device_type, browser, browser_version,
+                         os_name, os_version)
+
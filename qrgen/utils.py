@@ -1,12 +1,40 @@
+import numpy as np
 import qrcode
 from PIL import Image, ImageDraw
+import base64
+import hashlib
 import io
+import itertools
+import os
+import shutil
+import tempfile
+import zipfile
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
+import billiard
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models.fields.files import FieldFile
 from django.http import HttpResponse
 from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import A4
 from reportlab.lib.utils import ImageReader
-from django.core.files import File
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from django.conf import settings
 import csv
 
+from . import encoder
+from .logos import LOGO_SCALE, logo_bitmap
+from .render_cache import render_cache, render_key
+
+
+# QR size whose logo bitmap is embedded in PDFs
+PRINT_LOGO_QR_SIZE = 1000
+
+QRMatrix = namedtuple('QRMatrix', ['modules', 'version', 'mask'])
+
 
 def hex_to_rgb(hex_color):
     """Convert hex color to RGB tuple"""
@@ -15,7 +43,8 @@ def hex_to_rgb(hex_color):
 
 
 def generate_qr_code(data, fill_color='#000000', back_color='#FFFFFF',
-                     error_correction='M', size=300, logo=None):
+                     error_correction='M', size=300, logo=None,
+                     modules=None):
     """
     Generate a QR code with custom colors and optional logo.
 
@@ -25,116 +54,467 @@ def generate_qr_code(data, fill_color='#000000', back_color='#FFFFFF',
         back_color: Hex color for background (e.g., '#FFFFFF')
         error_correction: Error correction level ('L', 'M', 'Q', 'H')
         size: Size of the QR code in pixels
-        logo: Optional PIL Image for logo
+        logo: Optional logo, a stored file or PIL Image
+        modules: Optional stored encoding of data (see encode_qr)
 
     Returns:
-        PIL Image object
-    """
-    # Convert hex to RGB
-    fill_rgb = hex_to_rgb(fill_color)
-    back_rgb = hex_to_rgb(back_color)
-
-    # Create QR code
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=error_correction_map[error_correction],
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(data)
-    qr.make(fit=True)
-
-    # Create image
-    img = qr.make_image(fill_color=fill_rgb, back_color=back_rgb).resize(
-        (size, size), Image.Resampling.LANCZOS
-    )
+        PIL Image object: a two-color palette image, or RGB when a logo
+        is pasted on it
+    """
+    matrix = make_matrix(data, error_correction, modules=modules)
+    img = rasterize(matrix, size, hex_to_rgb(fill_color),
+                    hex_to_rgb(back_color), mode='RGB' if logo else 'P')
 
     # Add logo if provided
     if logo:
-        if isinstance(logo, File):
-            logo_img = Image.open(logo)
-        else:
-            logo_img = logo
-        img = add_logo_to_qr(img, logo_img, size)
+        img = add_logo_to_qr(img, logo, size)
 
     return img
 
 
+@lru_cache(maxsize=settings.QR_MATRIX_CACHE_SIZE)
+def encode_qr(data, error_correction='M'):
+    """
+    Encode data at the smallest version that fits and the best mask.
+
+    Returns a QRMatrix whose modules are a read-only uint8 array (1 for
+    dark) without the quiet zone. Results are memoized, so re-rendering the
+    same payload in other colors or sizes does not re-encode it.
+    """
+    modules, version, mask = encoder.encode(
+        data, error_correction_map[error_correction])
+    modules.setflags(write=False)
+    return QRMatrix(modules, version, mask)
+
+
+def matrix_key(data, error_correction):
+    """Hash of the inputs that determine the encoded matrix"""
+    return hashlib.sha256(f'{error_correction}\0{data}'.encode()).hexdigest()
+
+
+def pack_modules(modules):
+    """Bit-pack a module matrix, eight modules per byte"""
+    return np.packbits(modules).tobytes()
+
+
+def unpack_modules(packed, version):
+    """Inverse of pack_modules for a code of the given version"""
+    width = version * 4 + 17
+    bits = np.unpackbits(np.frombuffer(bytes(packed), dtype=np.uint8),
+                         count=width * width)
+    return bits.reshape(width, width)
+
+
+def make_matrix(data, error_correction='M', border=4, modules=None):
+    """
+    Return the module matrix for data, quiet zone included.
+
+    The matrix is a uint8 array, 1 for dark modules. Pass ``modules`` (a
+    stored encoding of data) to skip encoding.
+    """
+    if modules is None:
+        modules = encode_qr(data, error_correction).modules
+    return np.pad(modules, border)
+
+
+def rasterize(matrix, size, fill_rgb, back_rgb, mode='RGB'):
+    """
+    Draw a module matrix as a size x size image.
+
+    Each pixel takes the color of the module under it (nearest neighbour),
+    so edges stay sharp. When size is a multiple of the module count every
+    module is exactly size / modules pixels wide. With mode 'P' the
+    two-entry palette image is returned as is; otherwise it is converted.
+    """
+    modules = np.asarray(matrix, dtype=np.uint8)
+    index = (np.arange(size) * len(modules)) // size
+    pixels = np.ascontiguousarray(modules[index][:, index])
+
+    # Two-entry palette image: index 0 is the background, 1 the modules
+    img = Image.frombuffer('P', (size, size), pixels, 'raw', 'P', 0, 1)
+    img.putpalette(back_rgb + fill_rgb)
+    if mode == 'P':
+        return img
+    return img.convert(mode)
+
+
 def add_logo_to_qr(qr_img, logo, qr_size):
     """Add a logo to the center of the QR code"""
-    # Resize logo
-    logo_size = int(qr_size * 0.25)
-    logo_resized = logo.resize(
-        (logo_size, logo_size), Image.Resampling.LANCZOS)
-
-    # Convert to RGBA if needed
-    if logo_resized.mode != 'RGBA':
-        logo_resized = logo_resized.convert('RGBA')
+    logo_img = logo_bitmap(logo, qr_size)
 
     # Calculate position to center logo
     qr_width, qr_height = qr_img.size
-    logo_width, logo_height = logo_resized.size
+    logo_width, logo_height = logo_img.size
 
     position = ((qr_width - logo_width) // 2, (qr_height - logo_height) // 2)
 
     # Paste logo on QR code with alpha transparency
-    qr_img.paste(logo_resized, position, logo_resized)
+    qr_img.paste(logo_img, position, logo_img)
 
     return qr_img
 
 
 def qr_to_png(qr_img):
-    """Convert QR code to PNG format"""
+    """
+    Convert QR code to PNG format.
+
+    Two-color palette images are written with 1-bit pixels, so a row of
+    pixels is size / 8 bytes before compression; images with a logo keep
+    full color. zlib level and strategy come from settings.
+    """
+    options = {
+        'compress_level': settings.QR_PNG_COMPRESS_LEVEL,
+        'compress_type': settings.QR_PNG_ZLIB_STRATEGY,
+    }
+    if qr_img.mode == 'P' and len(qr_img.getpalette()) <= 6:
+        options['bits'] = 1
     buffer = io.BytesIO()
-    qr_img.save(buffer, format='PNG')
+    qr_img.save(buffer, format='PNG', **options)
     buffer.seek(0)
     return buffer
 
 
-def qr_to_svg(qr_img, data):
-    """Convert QR code to SVG format (simplified)"""
-    # For simplicity, we'll generate SVG using qrcode directly
-    qr = qrcode.QRCode(version=1, box_size=10, border=4)
-    qr.add_data(data)
-    qr.make(fit=True)
+def dark_runs(matrix):
+    """
+    Yield (row, start, length) for each horizontal run of dark modules.
+
+    Runs are found with one vectorized pass per row, so the cost is linear
+    in the number of modules.
+    """
+    modules = np.asarray(matrix, dtype=np.int8)
+    padded = np.zeros((modules.shape[0], modules.shape[1] + 2), np.int8)
+    padded[:, 1:-1] = modules
+    edges = np.diff(padded, axis=1)
+    for y, row in enumerate(edges):
+        starts = np.flatnonzero(row == 1)
+        ends = np.flatnonzero(row == -1)
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            yield y, start, end - start
+
+
+def svg_chunks(matrix, fill_color, back_color, size, logo=None):
+    """
+    Yield an SVG document for a module matrix piece by piece.
+
+    The matrix is drawn in module units (viewBox) and scaled to ``size``
+    pixels. All dark modules go into a single path, one rectangle per run.
+    """
+    modules = len(matrix)
+    fill = '#%02x%02x%02x' % hex_to_rgb(fill_color)
+    back = '#%02x%02x%02x' % hex_to_rgb(back_color)
+
+    yield (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+           f'<svg xmlns="http://www.w3.org/2000/svg" '
+           f'xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" '
+           f'width="{size}" height="{size}" '
+           f'viewBox="0 0 {modules} {modules}" shape-rendering="crispEdges">\n'
+           f'<rect width="{modules}" height="{modules}" fill="{back}"/>\n'
+           f'<path fill="{fill}" d="')
+    line = []
+    for y, x, width in dark_runs(matrix):
+        line.append(f'M{x},{y}h{width}v1h-{width}z')
+        if len(line) >= 256:
+            yield ''.join(line)
+            line = []
+    yield ''.join(line)
+    yield '"/>\n'
+
+    if logo:
+        # Same placement as add_logo_to_qr: centered, a quarter of the width
+        png = io.BytesIO()
+        logo_bitmap(logo, size).save(png, format='PNG')
+        logo_size = modules * LOGO_SCALE
+        offset = (modules - logo_size) / 2
+        yield (f'<image x="{offset:g}" y="{offset:g}" '
+               f'width="{logo_size:g}" height="{logo_size:g}" '
+               f'xlink:href="data:image/png;base64,')
+        yield base64.b64encode(png.getvalue()).decode()
+        yield '"/>\n'
 
-    # Create SVG buffer
-    svg_buffer = io.StringIO()
-    qr.print_ascii(out=svg_buffer)
-    svg_buffer.seek(0)
+    yield '</svg>\n'
 
-    # Convert to proper SVG
-    svg_content = f"""<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="300" height="300">
-    <rect width="300" height="300" fill="white"/>
-    <text x="150" y="150" font-family="Arial" font-size="14" text-anchor="middle">QR Code SVG</text>
-</svg>"""
 
+def qr_to_svg(data, fill_color='#000000', back_color='#FFFFFF',
+              error_correction='M', size=300, logo=None, modules=None):
+    """Convert QR code to SVG format"""
+    matrix = make_matrix(data, error_correction, modules=modules)
     buffer = io.BytesIO()
-    buffer.write(svg_content.encode())
+    for chunk in svg_chunks(matrix, fill_color, back_color, size, logo):
+        buffer.write(chunk.encode())
     buffer.seek(0)
     return buffer
 
 
-def qr_to_pdf(qr_img):
-    """Convert QR code to PDF format"""
-    buffer = io.BytesIO()
-    img_data = io.BytesIO()
-    qr_img.save(img_data, format='PNG')
-    img_data.seek(0)
+def draw_qr_pdf(pdf, matrix, x, y, size, fill_color, back_color, logo=None):
+    """
+    Draw a module matrix on a reportlab canvas as vector rectangles.
 
-    # Create PDF with QR code
-    p = canvas.Canvas(buffer)
-    img_reader = ImageReader(img_data)
-    width, height = qr_img.size
+    (x, y) is the bottom-left corner of the code and size its width in
+    points. Dark runs are filled as one path.
+    """
+    modules = len(matrix)
+    scale = size / modules
+    top = y + size
+
+    pdf.setFillColorRGB(*(c / 255 for c in hex_to_rgb(back_color)))
+    pdf.rect(x, y, size, size, stroke=0, fill=1)
 
-    p.drawImage(img_reader, 0, 0, width=width, height=height)
-    p.showPage()
-    p.save()
+    path = pdf.beginPath()
+    for row, column, width in dark_runs(matrix):
+        path.rect(x + column * scale, top - (row + 1) * scale,
+                  width * scale, scale)
+    pdf.setFillColorRGB(*(c / 255 for c in hex_to_rgb(fill_color)))
+    pdf.drawPath(path, stroke=0, fill=1)
 
+    if logo:
+        # Same placement as add_logo_to_qr. Points are not pixels, so use
+        # the bitmap for the largest code size to keep prints sharp.
+        logo_img = logo_bitmap(logo, PRINT_LOGO_QR_SIZE)
+        logo_size = size * LOGO_SCALE
+        offset = (size - logo_size) / 2
+        pdf.drawImage(ImageReader(logo_img),
+                      x + offset, y + offset, width=logo_size,
+                      height=logo_size, mask='auto')
+
+
+def qr_to_pdf(data, fill_color='#000000', back_color='#FFFFFF',
+              error_correction='M', size=300, logo=None, modules=None):
+    """Convert QR code to a single-page vector PDF, one point per pixel"""
+    matrix = make_matrix(data, error_correction, modules=modules)
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=(size, size), pageCompression=1)
+    draw_qr_pdf(pdf, matrix, 0, 0, size, fill_color, back_color, logo)
+    pdf.showPage()
+    pdf.save()
     buffer.seek(0)
     return buffer
 
 
+SheetEntry = namedtuple('SheetEntry', [
+    'data', 'label', 'fill_color', 'back_color', 'error_correction', 'logo',
+    'modules'], defaults=['', '#000000', '#FFFFFF', 'M', None, None])
+
+
+def qr_sheet_to_pdf(entries, output, columns=3, rows=7, pagesize=A4,
+                    margin=36, gutter=12, font_size=8):
+    """
+    Lay out many QR codes per page as a printable label sheet.
+
+    Args:
+        entries: Iterable of SheetEntry, consumed one at a time
+        output: Path or binary file object to write the PDF to
+        columns, rows: Grid of labels per page
+        pagesize: (width, height) in points
+        margin: Page margin in points
+        gutter: Space between labels in points
+        font_size: Label text size; 0 disables labels
+
+    Each code is encoded and drawn only when its cell is reached, so no
+    images are held. The drawn pages are: ReportLab keeps every page until
+    the document is saved, so split long runs with qr_sheets_to_zip.
+
+    Returns:
+        Number of codes drawn
+    """
+    page_width, page_height = pagesize
+    cell_width = (page_width - 2 * margin - (columns - 1) * gutter) / columns
+    cell_height = (page_height - 2 * margin - (rows - 1) * gutter) / rows
+    label_height = font_size * 1.5 if font_size else 0
+    code_size = min(cell_width, cell_height - label_height)
+    if code_size <= 0:
+        raise ValueError('Grid does not fit on the page')
+
+    pdf = canvas.Canvas(output, pagesize=pagesize, pageCompression=1)
+    per_page = columns * rows
+    count = 0
+    for count, entry in enumerate(entries, 1):
+        slot = (count - 1) % per_page
+        if slot == 0 and count > 1:
+            pdf.showPage()
+        column, row = slot % columns, slot // columns
+        left = margin + column * (cell_width + gutter)
+        bottom = page_height - margin - (row + 1) * cell_height - row * gutter
+
+        matrix = make_matrix(entry.data, entry.error_correction,
+                             modules=entry.modules)
+        x = left + (cell_width - code_size) / 2
+        y = bottom + label_height
+        draw_qr_pdf(pdf, matrix, x, y, code_size, entry.fill_color,
+                    entry.back_color, entry.logo)
+
+        if font_size and entry.label:
+            label = entry.label
+            while label and stringWidth(
+                    label, 'Helvetica', font_size) > cell_width:
+                label = label[:-1]
+            pdf.setFillColorRGB(0, 0, 0)
+            pdf.setFont('Helvetica', font_size)
+            pdf.drawCentredString(left + cell_width / 2,
+                                  bottom + font_size * 0.4, label)
+
+    if count:
+        pdf.showPage()
+    pdf.save()
+    return count
+
+
+def qr_sheets_to_zip(entries, output, max_pages, columns=3, rows=7,
+                     **layout):
+    """
+    Lay out a long run as a ZIP of label sheet PDFs of max_pages pages each.
+
+    Each PDF is saved to a temporary file and added to the archive before
+    the next is started, so memory is bounded by one part. Other arguments
+    are as for qr_sheet_to_pdf.
+
+    Returns:
+        Number of codes drawn
+    """
+    entries = iter(entries)
+    per_part = max_pages * columns * rows
+    total = 0
+    with zipfile.ZipFile(output, 'w') as zip_file:
+        for part in itertools.count(1):
+            with tempfile.TemporaryFile() as pdf:
+                drawn = qr_sheet_to_pdf(islice(entries, per_part), pdf,
+                                        columns=columns, rows=rows, **layout)
+                if not drawn:
+                    break
+                pdf.seek(0)
+                with zip_file.open(f'qr-codes-{part:03d}.pdf', 'w') as f:
+                    shutil.copyfileobj(pdf, f)
+            total += drawn
+    return total
+
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'pdf': 'application/pdf',
+}
+
+
+RenderSpec = namedtuple(
+    'RenderSpec',
+    ['data', 'fill_color', 'back_color', 'error_correction', 'size', 'logo',
+     'modules', 'format'],
+    defaults=('#000000', '#FFFFFF', 'M', 300, None, None, 'png'))
+
+# Logos read by each render pool worker, by storage name
+_worker_logos = {}
+
+
+def render_spec(spec, logos=None):
+    """
+    Render one RenderSpec to PNG, SVG or PDF bytes.
+
+    ``spec.logo`` may be a storage name, looked up in ``logos`` (the
+    logos the worker has read by default).
+    """
+    logo = spec.logo
+    if isinstance(logo, str):
+        logo = (_worker_logos if logos is None else logos)[logo]
+    args = (spec.data, spec.fill_color, spec.back_color,
+            spec.error_correction, spec.size, logo, spec.modules)
+    if spec.format == 'png':
+        return qr_to_png(generate_qr_code(*args)).getvalue()
+    elif spec.format == 'svg':
+        return qr_to_svg(*args).getvalue()
+    elif spec.format == 'pdf':
+        return qr_to_pdf(*args).getvalue()
+    raise ValueError(f'Unsupported format: {spec.format}')
+
+
+def _render_chunk(specs):
+    # A pool outlives batches, so logos are read as they first show up
+    names = {spec.logo for spec in specs if isinstance(spec.logo, str)}
+    _worker_logos.update(_read_logos(names - _worker_logos.keys()))
+    return [render_spec(spec) for spec in specs]
+
+
+def _read_logos(names):
+    logos = {}
+    for name in names:
+        with default_storage.open(name, 'rb') as f:
+            logos[name] = ContentFile(f.read(), name=name)
+    return logos
+
+
+@contextmanager
+def render_pool(processes=None):
+    """
+    Pool of render workers that successive render_batch calls share.
+
+    ``processes`` defaults to QR_RENDER_PROCESSES, or else to the CPUs
+    divided among the BULK_CONCURRENCY chunk tasks that may render at
+    once. The pool is billiard's (Celery's fork of multiprocessing), which,
+    unlike the standard library's, can be started from a daemonic process
+    such as a Celery prefork child. Yields None for a single process.
+    """
+    if processes is None:
+        processes = settings.QR_RENDER_PROCESSES or max(
+            os.cpu_count() // settings.BULK_CONCURRENCY, 1)
+    if processes <= 1:
+        yield None
+        return
+    pool = billiard.Pool(processes)
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def render_batch(specs, pool=None, chunk_size=16):
+    """
+    Render a list of RenderSpecs, yielding their bytes in order.
+
+    Work is spread over ``pool`` (see render_pool) in chunks of
+    ``chunk_size`` specs; without a pool, specs are rendered serially in
+    this process. Stored logos (model file fields or storage names) are
+    sent to workers by name and read once per worker. At most two chunks
+    per worker are in flight, so results never pile up ahead of the caller.
+    """
+    specs = [spec._replace(logo=spec.logo.name or None)
+             if isinstance(spec.logo, FieldFile) else spec for spec in specs]
+
+    if pool is None:
+        logos = _read_logos({spec.logo for spec in specs
+                             if isinstance(spec.logo, str)})
+        for spec in specs:
+            yield render_spec(spec, logos)
+        return
+
+    pending = deque()
+    for start in range(0, len(specs), chunk_size):
+        pending.append(pool.apply_async(
+            _render_chunk, (specs[start:start + chunk_size],)))
+        if len(pending) >= pool._processes * 2:
+            yield from pending.popleft().get()
+    while pending:
+        yield from pending.popleft().get()
+
+
+def render_qr_code(qr, data_url, format):
+    """
+    Render a saved QR code as PNG, SVG or PDF bytes.
+
+    Results are served from the render cache when the same image has been
+    rendered before.
+    """
+    key = render_key(format, data_url, qr.fill_color, qr.back_color,
+                     qr.error_correction, qr.size,
+                     qr.logo.name if qr.logo else None)
+
+    def render():
+        return render_spec(RenderSpec(
+            data_url, qr.fill_color, qr.back_color, qr.error_correction,
+            qr.size, qr.logo_prepared or qr.logo or None,
+            qr.stored_modules(data_url), format))
+
+    return render_cache.get_or_render(str(qr.pk), key, render)
+
+
 error_correction_map = {
     'L': qrcode.constants.ERROR_CORRECT_L,
     'M': qrcode.constants.ERROR_CORRECT_M,
@@ -1,24 +1,52 @@
 import json
 from .tasks import process_bulk_qr_code
-from .utils import generate_qr_code, qr_to_png, qr_to_svg, qr_to_pdf
+from .utils import (generate_qr_code, qr_to_png, render_qr_code,
+                    qr_sheet_to_pdf, qr_sheets_to_zip, SheetEntry,
+                    CONTENT_TYPES,
+                    error_correction_map)
+from .render_cache import render_cache, render_key
 from .forms import QRCodeForm, QRCodeUpdateForm, BulkUploadForm
 from .models import User, QRCode, Scan, BulkQRJob
+from .cache import aresolve_short_url
+from .ingest import arecord_scan
+import asyncio
 import base64
+import functools
 import io
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.urls import reverse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, authenticate, logout as auth_logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
 from django.views.decorators.http import require_http_methods
-from django.http import JsonResponse, FileResponse, HttpResponse
+from django.http import (JsonResponse, FileResponse, HttpResponse, Http404,
+                         HttpResponseNotAllowed, HttpResponseNotModified)
 from django.contrib import messages
 from django.db.models import Count, Q
 from django.core.paginator import Paginator
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from datetime import timedelta
 import matplotlib
 matplotlib.use('Agg')
 
+HEX_COLOR_RE = re.compile(r'#[0-9A-Fa-f]{6}')
+
+# Bounded pool for CPU-bound rendering so async views never block the loop
+render_executor = ThreadPoolExecutor(
+    max_workers=settings.RENDER_THREAD_POOL_SIZE,
+    thread_name_prefix='qr-render')
+
 
 def logout_view(request):
     """User logout"""
@@ -135,188 +163,246 @@ def qr_detail(request, pk):
     """View and download QR codes"""
     qr = get_object_or_404(QRCode, pk=pk, user=request.user)
 
-    # Generate QR code image
-    data_url = qr.get_data_url(request)
-
-    # Get logo if exists
-    logo = None
-    if qr.logo:
-        from PIL import Image
-        logo = Image.open(qr.logo)
-
-    qr_img = generate_qr_code(
-        data_url,
-        qr.fill_color,
-        qr.back_color,
-        qr.error_correction,
-        qr.size,
-        logo
-    )
-
-    # Save QR to bytes for response
-    png_buffer = qr_to_png(qr_img)
-
     context = {
         'qr': qr,
-        'qr_image_data': base64.b64encode(png_buffer.getvalue()).decode(),
         'scan_count': qr.get_scan_count(),
     }
 
     return render(request, 'qr_detail.html', context)
 
 
-@login_required
-@require_http_methods(["POST"])
-def qr_preview(request):
-    """HTMX endpoint for QR code preview"""
-    data = request.POST.get('data')
-    fill_color = request.POST.get('fill_color', '#000000')
-    back_color = request.POST.get('back_color', '#FFFFFF')
-    error_correction = request.POST.get('error_correction', 'M')
-    size = int(request.POST.get('size', 300))
+def render_preview_png(data, fill_color, back_color, error_correction, size):
+    """
+    Preview image as PNG bytes, from the render cache or rendered.
 
-    if data:
+    Runs on the render thread pool.
+    """
+    def render():
         qr_img = generate_qr_code(
             data, fill_color, back_color, error_correction, size)
-        png_buffer = qr_to_png(qr_img)
-        qr_image_data = base64.b64encode(png_buffer.getvalue()).decode()
+        return qr_to_png(qr_img).getvalue()
+
+    key = render_key('png', data, fill_color, back_color,
+                     error_correction, size)
+    return render_cache.get_or_render('preview', key, render)
+
+
+PREVIEW_KEY_PREFIX = 'qrgen:preview:'
+PREVIEW_SALT = 'qrgen.preview'
+
+# Preview renders in progress in this process, by render key
+_pending_previews = {}
+
+
+def _latest_preview_key(request):
+    return f'{PREVIEW_KEY_PREFIX}latest:{request.session.session_key}'
+
+
+def _preview_color(value, default):
+    if HEX_COLOR_RE.fullmatch(value or ''):
+        return value
+    return default
+
+
+async def _is_authenticated(request):
+    return await sync_to_async(lambda: request.user.is_authenticated)()
+
+
+async def qr_preview(request):
+    """
+    HTMX endpoint for QR code preview.
 
-        return render(request, 'partials/qr_preview.html', {
-            'qr_image_data': qr_image_data
-        })
+    Renders nothing itself: returns markup pointing at qr_preview_image,
+    with the preview parameters signed into the URL so any process can
+    render them, at most once per parameter hash.
+    """
+    # login_required and require_http_methods are sync-only in Django 4.2
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    if not await _is_authenticated(request):
+        return redirect_to_login(request.get_full_path())
 
-    return render(request, 'partials/qr_preview.html', {'qr_image_data': None})
+    data = request.POST.get('data')
+    if not data:
+        return render(request, 'partials/qr_preview.html',
+                      {'preview_url': None})
+
+    fill_color = _preview_color(request.POST.get('fill_color'), '#000000')
+    back_color = _preview_color(request.POST.get('back_color'), '#FFFFFF')
+    error_correction = request.POST.get('error_correction', 'M')
+    if error_correction not in error_correction_map:
+        error_correction = 'M'
+
+    issued = time.time()
+    token = signing.dumps(
+        [data, fill_color, back_color, error_correction, issued],
+        salt=PREVIEW_SALT, compress=True)
+    # Only the newest preview of a session gets rendered. This is a hint:
+    # the cache may not be shared with the process serving the image.
+    await cache.aset(_latest_preview_key(request), issued,
+                     settings.QR_PREVIEW_TIMEOUT)
+
+    return render(request, 'partials/qr_preview.html', {
+        'preview_url': reverse('qr-preview-image', args=[token]),
+        'preview_size': settings.QR_PREVIEW_SIZE,
+    })
+
+
+async def qr_preview_image(request, token):
+    """Preview PNG for signed preview parameters, with ETag revalidation"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    if not await _is_authenticated(request):
+        return redirect_to_login(request.get_full_path())
+
+    try:
+        *params, issued = signing.loads(token, salt=PREVIEW_SALT,
+                                        max_age=settings.QR_PREVIEW_TIMEOUT)
+    except signing.SignatureExpired:
+        raise Http404('Preview expired')
+    except signing.BadSignature:
+        raise Http404('Invalid preview')
+    key = render_key('png', *params, settings.QR_PREVIEW_SIZE)
+
+    # The key hashes every render input, so it is a strong validator
+    etag = f'"{key}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    latest = await cache.aget(_latest_preview_key(request))
+    if latest is not None and latest > issued:
+        # Superseded by a newer edit
+        return HttpResponse(status=204)
+
+    # Concurrent requests for the same preview share one render. The render
+    # cache is read on the pool too, as its disk tier would block the loop.
+    future = _pending_previews.get(key)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            render_executor,
+            functools.partial(render_preview_png, *params,
+                              settings.QR_PREVIEW_SIZE))
+        _pending_previews[key] = future
+        future.add_done_callback(lambda _: _pending_previews.pop(key, None))
+    png_data = await asyncio.shield(future)
+
+    response = HttpResponse(png_data, content_type='image/png')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=86400, immutable'
+    return response
+
+
+def image_etag(qr, data_url, format):
+    """Strong validator for a rendered image of a QR code"""
+    key = render_key(format, data_url, qr.fill_color, qr.back_color,
+                     qr.error_correction, qr.size,
+                     qr.logo.name if qr.logo else None)
+    return f'"{key[:32]}-{qr.updated_at.timestamp():.6f}"'
+
+
+def qr_image_response(request, qr, format):
+    """
+    Rendered image of a QR code, or a 304 if the client's copy is current.
+
+    The payload of dynamic codes depends on the request host, so the ETag
+    covers it along with updated_at and the render parameters.
+    """
+    data_url = qr.get_data_url(request)
+    etag = image_etag(qr, data_url, format)
+    response = get_conditional_response(
+        request, etag=etag, last_modified=int(qr.updated_at.timestamp()))
+    if response is None:
+        response = HttpResponse(render_qr_code(qr, data_url, format),
+                                content_type=CONTENT_TYPES[format])
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(qr.updated_at.timestamp())
+    response['Cache-Control'] = settings.QR_IMAGE_CACHE_CONTROL
+    return response
+
+
+@login_required
+def qr_image(request, pk, format):
+    """QR code image for embedding in pages"""
+    if format not in CONTENT_TYPES:
+        raise Http404('Unsupported format')
+    qr = get_object_or_404(QRCode, pk=pk, user=request.user)
+    return qr_image_response(request, qr, format)
 
 
 @login_required
 def download_qr(request, pk, format):
     """Download QR code in specified format"""
     qr = get_object_or_404(QRCode, pk=pk, user=request.user)
-    data_url = qr.get_data_url(request)
 
-    logo = None
-    if qr.logo:
-        from PIL import Image
-        logo = Image.open(qr.logo)
-
-    qr_img = generate_qr_code(
-        data_url,
-        qr.fill_color,
-        qr.back_color,
-        qr.error_correction,
-        qr.size,
-        logo
-    )
-
-    if format == 'png':
-        buffer = qr_to_png(qr_img)
-        response = HttpResponse(buffer, content_type='image/png')
-        response['Content-Disposition'] = f'attachment; filename="{qr.name}.png"'
-        return response
+    if format not in CONTENT_TYPES:
+        return redirect('qr-detail', pk=pk)
 
-    elif format == 'svg':
-        buffer = qr_to_svg(qr_img, data_url)
-        response = HttpResponse(buffer, content_type='image/svg+xml')
-        response['Content-Disposition'] = f'attachment; filename="{qr.name}.svg"'
-        return response
+    response = qr_image_response(request, qr, format)
+    response['Content-Disposition'] = f'attachment; filename="{qr.name}.{format}"'
+    return response
 
-    elif format == 'pdf':
-        buffer = qr_to_pdf(qr_img)
-        response = HttpResponse(buffer, content_type='application/pdf')
-        response['Content-Disposition'] = f'attachment; filename="{qr.name}.pdf"'
-        return response
 
-    return redirect('qr-detail', pk=pk)
+@login_required
+def print_sheet(request):
+    """
+    Download all of the user's QR codes as a printable label sheet.
+
+    Runs longer than PRINT_SHEET_MAX_PAGES pages come as a ZIP of PDFs.
+    """
+    try:
+        columns = min(max(int(request.GET.get('columns', 3)), 1), 10)
+        rows = min(max(int(request.GET.get('rows', 7)), 1), 20)
+    except ValueError:
+        columns, rows = 3, 7
+
+    codes = QRCode.objects.filter(user=request.user).order_by('pk')
+
+    def entries():
+        for qr in codes.iterator():
+            data_url = qr.get_data_url(request)
+            yield SheetEntry(data_url, qr.name, qr.fill_color, qr.back_color,
+                             qr.error_correction,
+                             qr.logo_prepared or qr.logo or None,
+                             qr.stored_modules(data_url))
+
+    # Spool to disk so large runs are streamed back instead of held in memory
+    output = tempfile.TemporaryFile()
+    max_pages = settings.PRINT_SHEET_MAX_PAGES
+    if codes.count() > max_pages * columns * rows:
+        qr_sheets_to_zip(entries(), output, max_pages, columns=columns,
+                         rows=rows)
+        filename, content_type = 'qr-codes.zip', 'application/zip'
+    else:
+        qr_sheet_to_pdf(entries(), output, columns=columns, rows=rows)
+        filename, content_type = 'qr-codes.pdf', 'application/pdf'
+    output.seek(0)
+    return FileResponse(output, as_attachment=True, filename=filename,
+                        content_type=content_type)
 
 
-def redirect_qr(request, short_url):
+async def redirect_qr(request, short_url):
     """Redirect short URL to destination URL"""
-    qr = get_object_or_404(QRCode, short_url=short_url, qr_type='dynamic')
+    resolved = await aresolve_short_url(short_url)
+    if resolved is None:
+        raise Http404('No QR code matches the given short URL.')
 
     # Log the scan
-    log_scan(request, qr)
+    await log_scan(request, resolved.pk)
 
     # Redirect to destination URL
-    return redirect(qr.destination_url)
+    return redirect(resolved.destination_url)
 
 
-def log_scan(request, qr_code):
-    """Log QR code scan with analytics"""
+async def log_scan(request, qr_code_id):
+    """Queue a QR code scan for analytics"""
     ip_address = request.META.get('REMOTE_ADDR', '')
     user_agent = request.META.get('HTTP_USER_AGENT', '')
 
-    # Parse user agent for device, browser, OS
-    device_type = parse_device_type(user_agent)
-    browser = parse_browser(user_agent)
-    os = parse_os(user_agent)
-
-    # GeoIP lookup (simplified - in production use MaxMind GeoIP2)
-    country = get_country_from_ip(ip_address)
-    city = get_city_from_ip(ip_address)
-
-    Scan.objects.create(
-        qr_code=qr_code,
-        ip_address=ip_address,
-        user_agent=user_agent,
-        country=country,
-        city=city,
-        device_type=device_type,
-        browser=browser,
-        os=os,
-    )
-
-
-def parse_device_type(user_agent):
-    """Parse device type from user agent"""
-    ua_lower = user_agent.lower()
-    if 'mobile' in ua_lower or 'android' in ua_lower:
-        return 'Mobile'
-    elif 'tablet' in ua_lower or 'ipad' in ua_lower:
-        return 'Tablet'
-    else:
-        return 'Desktop'
-
-
-def parse_browser(user_agent):
-    """Parse browser from user agent"""
-    if 'Chrome' in user_agent:
-        return 'Chrome'
-    elif 'Firefox' in user_agent:
-        return 'Firefox'
-    elif 'Safari' in user_agent:
-        return 'Safari'
-    elif 'Edge' in user_agent:
-        return 'Edge'
-    else:
-        return 'Unknown'
-
-
-def parse_os(user_agent):
-    """Parse OS from user agent"""
-    if 'Windows' in user_agent:
-        return 'Windows'
-    elif 'Mac' in user_agent:
-        return 'macOS'
-    elif 'Linux' in user_agent:
-        return 'Linux'
-    elif 'Android' in user_agent:
-        return 'Android'
-    elif 'iOS' in user_agent or 'iPhone' in user_agent or 'iPad' in user_agent:
-        return 'iOS'
-    else:
-        return 'Unknown'
-
-
-def get_country_from_ip(ip_address):
-    """Get country from IP address"""
-    # Simplified - in production use MaxMind GeoIP2 database
-    return 'Unknown'
-
-
-def get_city_from_ip(ip_address):
-    """Get city from IP address"""
-    # Simplified - in production use MaxMind GeoIP2 database
-    return 'Unknown'
+    # Device, browser, OS and location are filled in when the buffer is flushed
+    await arecord_scan(qr_code_id, ip_address, user_agent)
 
 
 @login_required
@@ -0,0 +1,36 @@
+"""
+ASGI config for quantumqr project.
+"""
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
+from django.core.asgi import get_asgi_application
+from django.views import static
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'quantumqr.settings')
+
+application = get_asgi_application()
+
+# Names written by the manifest storage, e.g. app.3f2a1b9c8d7e.css
+HASHED_NAME_RE = re.compile(r'\.[0-9a-f]{12}\.\w+$')
+
+
+class CollectedStaticFiles(ASGIStaticFilesHandler):
+    """
+    Serve STATIC_ROOT ahead of the application, in the worker's thread
+    pool, so no Django middleware has to be adapted for static requests.
+    Files with a content hash in their name are cached for a year.
+    """
+
+    def serve(self, request):
+        response = static.serve(request, self.file_path(request.path),
+                                document_root=settings.STATIC_ROOT)
+        if HASHED_NAME_RE.search(request.path):
+            response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
+
+if settings.SERVE_STATIC_FILES:
+    application = CollectedStaticFiles(application)
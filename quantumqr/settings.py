@@ -43,9 +43,11 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-# Add WhiteNoise for static files in production
-if 'DYNO' in os.environ or 'RENDER' in os.environ or 'RAILWAY' in os.environ:
-    MIDDLEWARE.insert(1, 'whitenoise.middleware.WhiteNoiseMiddleware')
+# Serve collected static files from the app itself in production. This is
+# done around the application (see asgi.py / wsgi.py), not by WhiteNoise's
+# middleware: it is sync-only and would put every ASGI request on a thread.
+SERVE_STATIC_FILES = ('DYNO' in os.environ or 'RENDER' in os.environ
+                      or 'RAILWAY' in os.environ)
 
 ROOT_URLCONF = 'quantumqr.urls'
 
@@ -66,6 +68,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'quantumqr.wsgi.application'
+ASGI_APPLICATION = 'quantumqr.asgi.application'
 
 
 # Database
@@ -77,6 +80,23 @@ DATABASES = {
 }
 
 
+# Cache
+# Use Redis when available so every web process shares one cache
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -106,8 +126,8 @@ STATIC_URL = '/static/'
 STATICFILES_DIRS = [BASE_DIR / 'static']
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 
-# Static files handling with WhiteNoise (configured in MIDDLEWARE above)
-if 'DYNO' in os.environ or 'RENDER' in os.environ or 'RAILWAY' in os.environ:
+# Hashed, pre-compressed static files when served by the app
+if SERVE_STATIC_FILES:
     STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 MEDIA_URL = '/media/'
@@ -131,3 +151,136 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+# Run tasks inline, without a broker (local development)
+CELERY_TASK_ALWAYS_EAGER = os.environ.get(
+    'CELERY_TASK_ALWAYS_EAGER', 'False') == 'True'
+
+# Bulk jobs are split into chunks of rows rendered by separate tasks, at
+# most BULK_CONCURRENCY chunks at a time
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+BULK_CONCURRENCY = int(os.environ.get('BULK_CONCURRENCY', 4))
+# Rows rendered, then inserted in one transaction, at a time by a chunk
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 500))
+# Seconds a started chunk may go without finishing a batch before its job
+# is reclaimed
+BULK_STALE_AFTER = int(os.environ.get('BULK_STALE_AFTER', 900))
+
+# Short URL resolution cache (redirect hot path)
+SHORT_URL_CACHE_SIZE = int(os.environ.get('SHORT_URL_CACHE_SIZE', 10000))
+SHORT_URL_CACHE_LOCAL_TTL = float(
+    os.environ.get('SHORT_URL_CACHE_LOCAL_TTL', 5))
+SHORT_URL_CACHE_TIMEOUT = int(os.environ.get('SHORT_URL_CACHE_TIMEOUT', 3600))
+SHORT_URL_NEGATIVE_CACHE_TIMEOUT = int(
+    os.environ.get('SHORT_URL_NEGATIVE_CACHE_TIMEOUT', 30))
+
+# Membership filter rejecting short URLs that cannot exist
+SHORT_URL_FILTER_REBUILD_INTERVAL = int(
+    os.environ.get('SHORT_URL_FILTER_REBUILD_INTERVAL', 300))
+SHORT_URL_FILTER_ERROR_RATE = float(
+    os.environ.get('SHORT_URL_FILTER_ERROR_RATE', 0.001))
+SHORT_URL_HIGH_WATER_REFRESH = float(
+    os.environ.get('SHORT_URL_HIGH_WATER_REFRESH', 1))
+
+# Short URL allocation: codes reserved per process from a counter row.
+# SHORT_URL_SCRAMBLE only applies when the counter row is first created.
+SHORT_URL_BLOCK_SIZE = int(os.environ.get('SHORT_URL_BLOCK_SIZE', 100))
+SHORT_URL_BLOCK_TTL = int(os.environ.get('SHORT_URL_BLOCK_TTL', 60))
+SHORT_URL_SCRAMBLE = os.environ.get('SHORT_URL_SCRAMBLE', 'True') == 'True'
+
+# Threads used by async views for CPU-bound QR rendering
+RENDER_THREAD_POOL_SIZE = int(os.environ.get('RENDER_THREAD_POOL_SIZE', 4))
+
+# Worker processes of the render pool each bulk chunk task starts. With up
+# to BULK_CONCURRENCY chunks at once, 0 (CPUs / BULK_CONCURRENCY) keeps the
+# machine busy without oversubscribing it.
+QR_RENDER_PROCESSES = int(os.environ.get('QR_RENDER_PROCESSES', 0))
+
+# Distinct user agents kept by the memoized scan classifier
+USER_AGENT_CACHE_SIZE = int(os.environ.get('USER_AGENT_CACHE_SIZE', 4096))
+
+# MaxMind-format GeoIP database (e.g. GeoLite2-City.mmdb) for scan locations
+GEOIP_DATABASE = os.environ.get(
+    'GEOIP_DATABASE', str(BASE_DIR / 'geoip' / 'GeoLite2-City.mmdb'))
+GEOIP_CACHE_SIZE = int(os.environ.get('GEOIP_CACHE_SIZE', 65536))
+
+# Cache of encoded QR images: in-memory LRU in front of an on-disk store
+RENDER_CACHE_MEMORY_BYTES = int(
+    os.environ.get('RENDER_CACHE_MEMORY_BYTES', 32 * 1024 * 1024))
+RENDER_CACHE_DIR = os.environ.get(
+    'RENDER_CACHE_DIR', str(BASE_DIR / 'cache' / 'renders'))
+RENDER_CACHE_DISK_BYTES = int(
+    os.environ.get('RENDER_CACHE_DISK_BYTES', 512 * 1024 * 1024))
+# Seconds between each process's log of its hit/miss counters; 0 disables
+RENDER_CACHE_STATS_INTERVAL = int(
+    os.environ.get('RENDER_CACHE_STATS_INTERVAL', 600))
+
+# qrgen logs operational stats (short URL filter rebuilds, render cache
+# hit rates) at INFO
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'qrgen': {
+            'handlers': ['console'],
+            'level': os.environ.get('QRGEN_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
+
+# Live preview: rendered at a fixed size; preview URLs expire after this
+# many seconds
+QR_PREVIEW_SIZE = int(os.environ.get('QR_PREVIEW_SIZE', 240))
+QR_PREVIEW_TIMEOUT = int(os.environ.get('QR_PREVIEW_TIMEOUT', 600))
+
+# Cache-Control for QR image responses; clients revalidate with the ETag
+QR_IMAGE_CACHE_CONTROL = os.environ.get(
+    'QR_IMAGE_CACHE_CONTROL', 'private, no-cache')
+
+# Public origin (e.g. https://qr.example.com) encoded in dynamic QR codes.
+# When unset the request host is used and images cannot be pre-encoded.
+QR_PUBLIC_BASE_URL = os.environ.get('QR_PUBLIC_BASE_URL', '').rstrip('/')
+
+# Encoded QR matrices memoized per process
+QR_MATRIX_CACHE_SIZE = int(os.environ.get('QR_MATRIX_CACHE_SIZE', 1024))
+
+# PNG output: zlib level (0-9) and strategy (0 default, 1 filtered,
+# 2 Huffman only, 3 RLE, 4 fixed)
+QR_PNG_COMPRESS_LEVEL = int(os.environ.get('QR_PNG_COMPRESS_LEVEL', 6))
+QR_PNG_ZLIB_STRATEGY = int(os.environ.get('QR_PNG_ZLIB_STRATEGY', 0))
+
+# Logos are shrunk to this working size (px) on upload; rendered bitmaps
+# per (logo, QR size) are kept in a per-process LRU
+LOGO_WORKING_SIZE = int(os.environ.get('LOGO_WORKING_SIZE', 512))
+LOGO_CACHE_SIZE = int(os.environ.get('LOGO_CACHE_SIZE', 64))
+
+# Pages per print sheet PDF; ReportLab keeps a document's pages in memory
+# until it is saved, so longer runs are split into a ZIP of PDFs
+PRINT_SHEET_MAX_PAGES = int(os.environ.get('PRINT_SHEET_MAX_PAGES', 50))
+
+# Scan ingestion buffer: 'local', 'redis' or 'direct'
+SCAN_BUFFER_BACKEND = os.environ.get('SCAN_BUFFER_BACKEND', 'local')
+SCAN_BUFFER_REDIS_URL = os.environ.get(
+    'SCAN_BUFFER_REDIS_URL', CELERY_BROKER_URL)
+SCAN_BUFFER_KEY = 'qrgen:scan_buffer'
+SCAN_BUFFER_MAX_SIZE = int(os.environ.get('SCAN_BUFFER_MAX_SIZE', 100000))
+SCAN_BUFFER_FLUSH_SIZE = int(os.environ.get('SCAN_BUFFER_FLUSH_SIZE', 500))
+SCAN_BUFFER_FLUSH_INTERVAL = float(
+    os.environ.get('SCAN_BUFFER_FLUSH_INTERVAL', 2))
+
+# Sent by the one beat process (see Procfile), not by workers, so scaling
+# workers does not duplicate scheduled tasks
+CELERY_BEAT_SCHEDULE = {
+    'reclaim-stale-bulk-jobs': {
+        'task': 'qrgen.tasks.reclaim_stale_bulk_jobs',
+        'schedule': 300,
+    },
+}
+# Only the Redis buffer is drained by Celery; the local one flushes itself
+if SCAN_BUFFER_BACKEND == 'redis':
+    CELERY_BEAT_SCHEDULE['flush-scan-buffer'] = {
+        'task': 'qrgen.tasks.flush_scan_buffer',
+        'schedule': SCAN_BUFFER_FLUSH_INTERVAL,
+    }
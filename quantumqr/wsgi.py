@@ -8,3 +8,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'quantumqr.settings')
 
 application = get_wsgi_application()
+
+from django.conf import settings  # noqa: E402
+
+if settings.SERVE_STATIC_FILES:
+    from whitenoise import WhiteNoise
+
+    application = WhiteNoise(application, root=settings.STATIC_ROOT,
+                             prefix=settings.STATIC_URL)